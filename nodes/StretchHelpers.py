@@ -6,13 +6,12 @@ This file contains helper functions for the stretch robot control.
 The helper functions include finding corrections to the robot arm when it
 reaches, the theta given the quaternion, etc
 
-
+geometry_msgs and tf are only imported by the functions that take or return
+ROS messages, so the array helpers work without ROS.
 """
 
-from geometry_msgs.msg import Transform
 import numpy as np
 from math import dist
-from tf.transformations import euler_from_quaternion, quaternion_from_euler
 
 def feedbackLin(arg_cmd_vx, arg_cmd_vy, arg_theta, arg_epsilon):
     """ Performs feedback linearization
@@ -38,6 +37,43 @@ def thresholdVel(arg_cmd_v, arg_cmd_w, arg_maxV, arg_wheel2center):
 
     return arg_cmd_v, arg_cmd_w
 
+def findLookaheadPoint(arg_path_xy, arg_robot_xy, arg_start_idx, arg_lookahead, arg_window=None):
+    """ Finds the pure pursuit target on a path
+
+    The closest path point to the robot is searched from arg_start_idx over the
+    next arg_window points (the rest of the path if None), so progress along the
+    path never goes backwards. Ties go to the furthest point, so repeated points
+    are passed. The target is the first point after it that is at least
+    arg_lookahead away from the robot, or the end of the path.
+
+    Args:
+        arg_path_xy: np.array [N, 2]
+        arg_robot_xy: np.array (2,)
+        arg_start_idx: int, index of the closest point found on the previous call
+        arg_lookahead: double
+        arg_window: int or None
+
+    Returns:
+        target_xy: np.array (2,)
+        closest_idx: int
+        cross_track_error: double, distance from the robot to the closest path point
+    """
+    end_idx = arg_path_xy.shape[0] if arg_window is None else min(arg_start_idx + arg_window, arg_path_xy.shape[0])
+    dists = np.hypot(arg_path_xy[arg_start_idx:end_idx, 0] - arg_robot_xy[0], arg_path_xy[arg_start_idx:end_idx, 1] - arg_robot_xy[1])
+    closest = dists.shape[0] - 1 - int(np.argmin(dists[::-1]))
+    ahead = np.nonzero(dists[closest:] >= arg_lookahead)[0]
+    target_idx = arg_start_idx + closest + ahead[0] if ahead.size else end_idx - 1
+    if ahead.size == 0 and end_idx < arg_path_xy.shape[0]:
+        target_idx = end_idx
+    return arg_path_xy[target_idx], arg_start_idx + closest, dists[closest]
+
+
+def wrapTheta(theta):
+    """ Wraps a heading, scalar or array, to [-pi/4, 2 pi - pi/4) like findTheta
+    """
+    return (theta + np.pi / 4) % (2 * np.pi) - np.pi / 4
+
+
 def findCommands(arg_cur_pose, arg_desired_pose):
     """ Finds the x and y velocity commands for the robot
     """
@@ -62,6 +98,7 @@ def findTheta(arg_cur_pose):
     q0 = arg_cur_pose.rotation.w
     # theta = np.arctan2(2 * (q1 * q2 + q0 * q3), q0 ** 2 + q1 ** 2 - q2 ** 2 - q3 **2)
     # theta = np.arctan2(2 * (q0 * q3 + q1 * q2), 1 - 2 * (q2 * q2 + q3 * q3))
+    from tf.transformations import euler_from_quaternion
     (_, _, theta) = euler_from_quaternion([q1, q2, q3, q0])
     # if not IS_SIM:
     #     theta -= np.pi
@@ -160,6 +197,123 @@ def findArmExtensionAndRotation(goal_pose, robot_pose_x, robot_pose_y, robot_the
     return amount_to_extend, wrist_theta
 
 
+# Headings tried when searching for a base rotation that lets the arm reach a
+# goal, ordered by increasing distance from the current heading: 0, -d, +2d, ...
+THETA_SEARCH_OFFSETS = np.linspace(0, 2 * np.pi, 1000) * np.tile([1, -1], 500)
+# Largest distance (m) between the goal and the forward kinematics of an arm solution that reaches it
+FK_TOLERANCE = 1e-3
+
+
+def findArmOrigin(robot_pose_x, robot_pose_y, robot_theta):
+    """ Finds the position of the base of the arm given the pose of the robot
+
+    Works on scalars or arrays of matching shape
+    """
+    arm_origin_x = robot_pose_x + 0.14 * np.cos(robot_theta) - 0.16 * (- np.sin(robot_theta))
+    arm_origin_y = robot_pose_y + 0.14 * np.sin(robot_theta) - 0.16 * np.cos(robot_theta)
+    return arm_origin_x, arm_origin_y
+
+
+def findArmExtensionAndRotationArrays(xd, yd, xr, yr, qrobot, GtoW=0.23):
+    """ Array version of findArmExtensionAndRotation
+
+    All inputs are broadcast against each other. Unreachable goals have nan
+    extension and wrist rotation.
+    """
+    q_arm = qrobot - (np.pi)/2
+    tan_q = np.tan(q_arm)
+
+    p = yr - (xr*tan_q) - yd
+    a = 1 + (tan_q**2)
+    b = (-2*xd) + (2*p*tan_q)
+    c = xd**2 + p**2 - GtoW**2
+    with np.errstate(invalid='ignore'):
+        sqrt_d = np.sqrt((b**2) - (4*a*c))
+
+    x1 = (-b + sqrt_d)/(2*a)
+    x2 = (-b - sqrt_d)/(2*a)
+    y1 = (tan_q * x1) + yr - (xr*tan_q)
+    y2 = (tan_q * x2) + yr - (xr*tan_q)
+
+    dist1 = np.hypot(x1 - xr, y1 - yr)
+    dist2 = np.hypot(x2 - xr, y2 - yr)
+    with np.errstate(invalid='ignore'):
+        use_pt1 = dist1 < dist2
+        amount_to_extend = np.where(use_pt1, dist1, dist2)
+        x_pt = np.where(use_pt1, x1, x2)
+        y_pt = np.where(use_pt1, y1, y2)
+
+        wrist_theta = np.arctan2(yd - y_pt, xd - x_pt) - q_arm
+        wrist_theta = np.where(wrist_theta >= 2*np.pi, wrist_theta - (2*np.pi),
+                               np.where(wrist_theta < -0.1, wrist_theta + (2*np.pi), wrist_theta))
+
+        unreachable = np.isnan(amount_to_extend) | (amount_to_extend >= 0.5)
+    amount_to_extend = np.where(unreachable, np.nan, amount_to_extend)
+    wrist_theta = np.where(unreachable, np.nan, wrist_theta)
+
+    return amount_to_extend, wrist_theta
+
+
+def armSolutionReaches(goal_x, goal_y, arm_origin_x, arm_origin_y, headings, amount_to_extend, wrist_theta, fk_tolerance=FK_TOLERANCE):
+    """ Checks arm solutions with the forward kinematics
+
+    The IK can return a solution behind the arm, which the forward kinematics
+    maps away from the goal. Inputs are broadcast against each other.
+
+    Returns:
+        reaches: bool array, True where the end effector is within fk_tolerance of the goal
+    """
+    shape = np.broadcast(goal_x, goal_y, arm_origin_x, arm_origin_y, headings, amount_to_extend, wrist_theta).shape
+    goal_x, goal_y, arm_origin_x, arm_origin_y, headings, amount_to_extend, wrist_theta = \
+        [np.ravel(np.broadcast_to(v, shape)) for v in (goal_x, goal_y, arm_origin_x, arm_origin_y, headings, amount_to_extend, wrist_theta)]
+    ee_xy = forwardKinematicsStretchBatch(np.column_stack([arm_origin_x, arm_origin_y, headings]), amount_to_extend, wrist_theta)
+    with np.errstate(invalid='ignore'):
+        reaches = np.hypot(ee_xy[:, 0] - goal_x, ee_xy[:, 1] - goal_y) < fk_tolerance
+    return np.reshape(reaches, shape)
+
+
+def findHeadingArmExtensionAndRotation(robot_pose_x, robot_pose_y, goal_x, goal_y, robot_theta, theta_offsets=THETA_SEARCH_OFFSETS, fk_tolerance=None):
+    """ Finds the base heading, arm extension and wrist rotation to reach a goal
+
+    Every heading robot_theta + theta_offsets is evaluated at once and the first
+    one (in the order of theta_offsets) from which the goal is reachable is
+    chosen. If none is reachable the last heading is returned with nan extension.
+
+    Args:
+        robot_pose_x, robot_pose_y: position of the base, scalars or (N,) arrays
+        goal_x, goal_y: position of the end effector goal, scalars or (N,) arrays
+        robot_theta: current heading of the base, scalar or (N,) array
+        theta_offsets: (K,) array of heading offsets to try
+        fk_tolerance: if given, solutions whose forward kinematics miss the goal by more are rejected
+
+    Returns:
+        amount_to_extend, wrist_theta, heading: scalars or (N,) arrays
+    """
+    is_scalar = np.ndim(robot_pose_x) == 0 and np.ndim(goal_x) == 0 and np.ndim(robot_theta) == 0
+    shape = np.broadcast(robot_pose_x, robot_pose_y, goal_x, goal_y, robot_theta).shape
+    robot_pose_x, robot_pose_y, goal_x, goal_y, robot_theta = \
+        [np.reshape(np.broadcast_to(v, shape), [-1, 1]) for v in (robot_pose_x, robot_pose_y, goal_x, goal_y, robot_theta)]
+
+    headings = robot_theta + np.reshape(theta_offsets, [1, -1])
+    arm_origin_x, arm_origin_y = findArmOrigin(robot_pose_x, robot_pose_y, headings)
+    amount_to_extend, wrist_theta = findArmExtensionAndRotationArrays(goal_x, goal_y, arm_origin_x, arm_origin_y, headings)
+
+    valid = (headings < 2 * np.pi) & ~np.isnan(amount_to_extend)
+    if fk_tolerance is not None:
+        valid &= armSolutionReaches(goal_x, goal_y, arm_origin_x, arm_origin_y, headings, amount_to_extend, wrist_theta, fk_tolerance)
+        amount_to_extend = np.where(valid, amount_to_extend, np.nan)
+        wrist_theta = np.where(valid, wrist_theta, np.nan)
+    idx = np.where(np.any(valid, axis=1), np.argmax(valid, axis=1), headings.shape[1] - 1)
+    rows = np.arange(headings.shape[0])
+    amount_to_extend = amount_to_extend[rows, idx]
+    wrist_theta = wrist_theta[rows, idx]
+    heading = headings[rows, idx]
+
+    if is_scalar:
+        return amount_to_extend[0], wrist_theta[0], heading[0]
+    return amount_to_extend, wrist_theta, heading
+
+
 def forwardKinematicsStretch(robot_posex, robot_posey, robottheta, arm_extension, theta_wrist, l_wrist = 0.23):
     """ Finds the forward kinematics of the stretch (in 2d) given the pose
 
@@ -184,6 +338,7 @@ def forwardKinematicsStretch(robot_posex, robot_posey, robottheta, arm_extension
     x_ee = arm_extension * np.cos(t_robot - np.pi/2) + l_wrist * np.cos(t_robot + theta_wrist - np.pi/2) + x_robot
     y_ee = arm_extension * np.sin(t_robot - np.pi/2) + l_wrist * np.sin(t_robot + theta_wrist - np.pi/2) + y_robot
 
+    from geometry_msgs.msg import Transform
     ee_pose = Transform()
     ee_pose.translation.x = x_ee
     ee_pose.translation.y = y_ee
@@ -191,6 +346,44 @@ def forwardKinematicsStretch(robot_posex, robot_posey, robottheta, arm_extension
     return ee_pose
 
 
+def findArmExtensionAndRotationBatch(goal_xy, robot_pose):
+    """ Array version of findArmExtensionAndRotation
+
+    Args:
+        goal_xy: np.array (N, 2) or (2,) with the x, y of the goal
+        robot_pose: np.array (N, 3) or (3,) with the x, y, theta the arm is extended from
+
+    Returns:
+        amount_to_extend: np.array (N,), nan where unreachable
+        wrist_theta: np.array (N,), nan where unreachable
+        reachable: np.array (N,) of bool
+    """
+    goal_xy = np.atleast_2d(goal_xy)
+    robot_pose = np.atleast_2d(robot_pose)
+    amount_to_extend, wrist_theta = findArmExtensionAndRotationArrays(goal_xy[:, 0], goal_xy[:, 1], robot_pose[:, 0], robot_pose[:, 1], robot_pose[:, 2])
+    return amount_to_extend, wrist_theta, ~np.isnan(amount_to_extend)
+
+
+def forwardKinematicsStretchBatch(robot_pose, arm_extension, theta_wrist, l_wrist=0.23):
+    """ Array version of forwardKinematicsStretch
+
+    Args:
+        robot_pose: np.array (N, 3) or (3,) with the x, y, theta of the robot
+        arm_extension: np.array (N,)
+        theta_wrist: np.array (N,) (radians)
+
+    Returns:
+        ee_xy: np.array (N, 2), nan rows where the extension or wrist angle is nan
+    """
+    robot_pose = np.atleast_2d(robot_pose)
+    t_robot = robot_pose[:, 2]
+    ee_xy = np.empty([np.broadcast(t_robot, arm_extension, theta_wrist).shape[0], 2])
+    ee_xy[:, 0] = arm_extension * np.cos(t_robot - np.pi/2) + l_wrist * np.cos(t_robot + theta_wrist - np.pi/2) + robot_pose[:, 0]
+    ee_xy[:, 1] = arm_extension * np.sin(t_robot - np.pi/2) + l_wrist * np.sin(t_robot + theta_wrist - np.pi/2) + robot_pose[:, 1]
+
+    return ee_xy
+
+
 def testArmExtensionAndRotation():
     """ Verifies that the arm extension and wrist rotation calculations are correct
     """
@@ -250,5 +443,22 @@ def testArmExtensionAndRotation():
                         # print("X: {:5.5f} Y: {:5.5f} Qr: {:5.5f} Ext: {:5.5f} Qw: {:5.5f}    =>     ErrorExtension: {:5.5f}          ErrorWrist: {:5.5f}".format(robot_pose.translation.x, robot_pose.translation.y, robot_pose.rotation.w, ex, tw, errorExt, errorTheta))
 
 
+def testArmExtensionAndRotationBatch(n_grid=10):
+    """ Verifies the batch arm extension and wrist rotation calculations over a grid of poses
+    """
+    xr, yr, ang, ex, tw = np.meshgrid(np.linspace(-2, 2, n_grid), np.linspace(-2, 2, n_grid),
+                                      np.linspace(0.0001, 2 * np.pi, n_grid, endpoint=False),
+                                      np.linspace(0, 0.5, n_grid, endpoint=False),
+                                      np.linspace(0, np.pi/2, n_grid, endpoint=False), indexing='ij')
+    robot_pose = np.stack([xr.ravel(), yr.ravel(), ang.ravel()], axis=1)
+    ee = forwardKinematicsStretchBatch(robot_pose, ex.ravel(), tw.ravel())
+    found_extension, found_theta, reachable = findArmExtensionAndRotationBatch(ee, robot_pose)
+    ee_found = forwardKinematicsStretchBatch(robot_pose, found_extension, found_theta)
+
+    ee_error = np.linalg.norm(ee_found - ee, axis=1)[reachable]
+    print("Poses: {} Reachable: {} Max EE error: {:5.5f}".format(robot_pose.shape[0], np.sum(reachable), np.max(ee_error)))
+
+
 if __name__ == "__main__":
     testArmExtensionAndRotation()
+    testArmExtensionAndRotationBatch()
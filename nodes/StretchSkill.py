@@ -2,62 +2,41 @@
 
 from __future__ import print_function
 
+import time
+STARTUP_TIME = time.time()
+
 from sensor_msgs.msg import JointState
 from geometry_msgs.msg import Twist, Quaternion, Transform
-from nav_msgs.msg import Odometry
 
 import rospy
 import actionlib
 from control_msgs.msg import FollowJointTrajectoryAction
 from control_msgs.msg import FollowJointTrajectoryGoal
 from trajectory_msgs.msg import JointTrajectoryPoint, JointTrajectory
-from gazebo_msgs.msg import ModelState
-from gazebo_msgs.srv import SetModelState
 from tf.transformations import quaternion_from_euler
 
-from visualization_msgs.msg import MarkerArray, Marker
-
-from geometry_msgs.msg import PointStamped
-
-from sensor_msgs.msg import PointCloud2
-
-from std_srvs.srv import Trigger, TriggerRequest, TriggerResponse
-from aut_tools import find_intermediate_symbols, find_skill_to_run, find_state_number, update_state, parse_spec, parse_aut, find_symbols
+from aut_tools import find_intermediate_symbols, find_intermediate_symbols_batch, decimate_trajectory, find_skill_to_run, find_state_number, update_state, parse_spec, parse_aut, find_symbols
 import argparse
-from synthesis_based_repair.skills import load_skills_from_json
-from synthesis_based_repair.symbols import load_symbols
-from synthesis_based_repair.visualization import plot_trajectories, create_ax_array, apply_plot_limits, plot_trajectory
-import matplotlib.pyplot as plt
 
-import math
-import time
 import threading
 import sys
 
 from math import dist
 
 import tf2_ros
-import argparse as ap
 import numpy as np
-import threading
-import ros_numpy as rn
-
-import hello_helpers.hello_misc as hm
-import moveit_commander
-import moveit_msgs.msg
-from moveit_commander.conversions import pose_to_list
-from synthesis_based_repair.tools import write_spec, clear_file, dict_to_formula, json_load_wrapper
-
-from dl2_lfd.nns.dmp_nn import DMPNN
-from dl2_lfd.dmps.dmp import load_dmp_demos, DMP
-import torch
-from dl2_lfd.helper_funcs.conversions import np_to_pgpu
-from gazebo_ros_link_attacher.srv import Attach, AttachRequest, AttachResponse
 
+# torch is only imported by dmp_tools when a DMP is first rolled out
+from dmp_tools import rolloutDMP, DMP_MODEL_CACHE
 
-from StretchHelpers import feedbackLin, thresholdVel, findCommands, findArmExtensionAndRotation, findTheta
-
-DEVICE="cpu"
+from StretchHelpers import feedbackLin, thresholdVel, findCommands, findTheta, findHeadingArmExtensionAndRotation, findLookaheadPoint
+from reachability import ReachabilityMap
+from world_state import WorldStateTracker, frameAge
+from state_schema import WorldStateSchema, StateRingBuffer
+from base_control import ControlLoop
+from speculative_planner import SpeculativePlanner
+from plot_renderer import TrajectoryPlotRenderer
+from joint_state import JointStateStore
 
 # import stretch_funmap.navigate as nv
 
@@ -84,14 +63,61 @@ else:
     DUCK1_FRAME = 'DuckA'
     DUCK2_FRAME = 'DuckB'
 
-class StretchSkill(hm.HelloNode):
+# Objects in the world state, can be overridden with the ~objects param
+OBJECT_FRAMES = [DUCK1_FRAME, DUCK2_FRAME]
+
+# Extension, lift and wrist yaw speeds used to time streamed arm trajectories
+ARM_MAX_VEL = np.array([0.1, 0.1, 0.5])
+ARM_MIN_DT = 0.1
+if IS_SIM:
+    ARM_TRAJECTORY_ACTION = '/stretch_arm_controller/follow_joint_trajectory'
+    ARM_JOINT_NAMES = ['joint_lift', 'joint_arm_l3', 'joint_arm_l2', 'joint_arm_l1', 'joint_arm_l0', 'joint_wrist_yaw']
+else:
+    ARM_TRAJECTORY_ACTION = '/stretch_controller/follow_joint_trajectory'
+    ARM_JOINT_NAMES = ['wrist_extension', 'joint_lift', 'joint_wrist_yaw']
+
+# Only the dependencies of the backend in use are imported, MoveIt and the
+# gazebo services are imported when the node is created in sim
+if IS_SIM:
+    StretchNode = object
+else:
+    import hello_helpers.hello_misc as hm
+    StretchNode = hm.HelloNode
+
+
+class StartupProfiler(object):
+    """ Records how long each phase of the node startup takes
+    """
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self.last_time = start_time
+        self.phases = []
+
+    def mark(self, phase):
+        """ Ends a phase, it lasted from the end of the previous phase until now
+        """
+        now = time.time()
+        self.phases.append((phase, now - self.last_time))
+        self.last_time = now
+
+    def report(self):
+        lines = ["{}: {:.2f} s".format(phase, duration) for (phase, duration) in self.phases]
+        rospy.loginfo("Startup took {:.2f} s\n  {}".format(self.last_time - self.start_time, "\n  ".join(lines)))
+
+
+STARTUP = StartupProfiler(STARTUP_TIME)
+STARTUP.mark("imports")
+
+class StretchSkill(StretchNode):
     def __init__(self):
         rospy.loginfo("Creating stretch skill")
-        self.lift_position = None
-        self.joint_states = None
-        self.wrist_position = None
-        self.wrist_yaw = None
+        # Latest joint states of both backends, kept up to date by subscription
+        self.joint_state_store = JointStateStore()
         if IS_SIM:
+            import moveit_commander
+            from gazebo_msgs.srv import SetModelState
+            from gazebo_ros_link_attacher.srv import Attach
+            STARTUP.mark("sim imports")
             moveit_commander.roscpp_initialize(sys.argv)
             rospy.init_node('controller', anonymous=True)
             robot = moveit_commander.RobotCommander()
@@ -103,82 +129,114 @@ class StretchSkill(hm.HelloNode):
             self.detach_srv.wait_for_service()
             self.teleport_base_srv = rospy.ServiceProxy('/gazebo/set_model_state', SetModelState)
             self.teleport_base_srv.wait_for_service()
+            self.joint_states_subscriber = rospy.Subscriber(rospy.get_param("~joint_states_topic", "/joint_states"), JointState, self.joint_state_store.update)
+            self.arm_trajectory_client = actionlib.SimpleActionClient(ARM_TRAJECTORY_ACTION, FollowJointTrajectoryAction)
+            if not self.arm_trajectory_client.wait_for_server(rospy.Duration(5.0)):
+                rospy.logwarn("Could not connect to {}, streamed arm trajectories will not run".format(ARM_TRAJECTORY_ACTION))
+            STARTUP.mark("moveit and gazebo services")
         else:
             hm.HelloNode.__init__(self)
             hm.HelloNode.main(self, 'stretch_control', 'stretch_skill_repair', wait_for_first_pointcloud=False)
-            self.joint_states_lock = threading.Lock()
             self.move_lock = threading.Lock()
             with self.move_lock:
                 self.handover_goal_ready = False
             self.joint_states_subscriber = rospy.Subscriber('/stretch/joint_states', JointState, self.joint_states_callback)
+            self.arm_trajectory_client = self.trajectory_client
+            STARTUP.mark("hello node")
         self.rate = rospy.Rate(20.0)
+        self.arm_stream_progress = 0
+        self.path_tracking_metrics = None
+        # Plots of planned trajectories are only saved after startPlotRenderer is called
+        self.plot_renderer = None
+
+        # Precomputed reachability map used to pick the base heading in cartesian trajectories
+        self.reach_map = None
+        reach_map_file = rospy.get_param("~reachability_map", "")
+        if reach_map_file:
+            self.reach_map = ReachabilityMap.load(reach_map_file)
+            rospy.loginfo("Loaded reachability map from {}".format(reach_map_file))
+            STARTUP.mark("reachability map")
 
         # For use with mobile base control
         self.tfBuffer = tf2_ros.Buffer()
         self.listener = tf2_ros.TransformListener(self.tfBuffer)
+        # Latest pose of every frame in the world state, updated in the background
+        self.world_state_tracker = WorldStateTracker(self.tfBuffer, update_rate=rospy.get_param("~world_state_rate", 50.0))
+        self.max_staleness = rospy.get_param("~world_state_max_staleness", 1.0)
+        self.last_world_snapshot = None
+        self.stretch_frame = None
+        self.ee_frame = None
+        self.state_min_width = rospy.get_param("~state_min_width", 12)
+        self.state_history_size = rospy.get_param("~state_history_size", 10000)
+        self.setObjectFrames([])
         self.vel_pub = rospy.Publisher(CMD_VEL_TOPIC, Twist, queue_size=10)
+        # The base controllers run at this rate on the latest pose from the world state tracker
+        self.base_control_loop = ControlLoop(rospy.get_param("~control_rate", 50.0))
+        # Longer than the keepalive period of gazebo_tf_publisher, which only resends frames that do not move that often
+        self.max_pose_staleness = rospy.get_param("~control_max_pose_staleness", 1.0)
+        STARTUP.mark("tf and world state")
+
+    def startPlotRenderer(self, symbols_file, plot_dir):
+        """ Saves a plot of every planned skill trajectory to plot_dir in a separate process
+        """
+        self.plot_renderer = TrajectoryPlotRenderer(symbols_file, plot_dir)
+        rospy.loginfo("Saving plots of planned trajectories to {}".format(plot_dir))
 
     def setStretchFrame(self, stretch_frame):
         self.stretch_frame = stretch_frame
+        self.updateTrackedFrames()
 
     def setEEFrame(self, ee_frame):
         self.ee_frame = ee_frame
+        self.updateTrackedFrames()
 
-    def setDuck1Frame(self, duck1_frame):
-        self.duck1_frame = duck1_frame
+    def setObjectFrames(self, object_frames):
+        """ Sets the objects in the world state, which also resets the world state history
+        """
+        self.state_schema = WorldStateSchema(object_frames, min_width=self.state_min_width)
+        self.state_history = StateRingBuffer(self.state_history_size, self.state_schema.width)
+        self.updateTrackedFrames()
 
-    def setDuck2Frame(self, duck2_frame):
-        self.duck2_frame = duck2_frame
+    def updateTrackedFrames(self):
+        frames = [frame for frame in [self.stretch_frame, self.ee_frame] if frame is not None]
+        self.world_state_tracker.setFrames(frames + self.state_schema.object_frames)
 
     def setOriginFrame(self, origin_frame):
         self.origin_frame = origin_frame
+        self.world_state_tracker.setOriginFrame(origin_frame)
 
-    def getWorldState(self):
+    def getWorldState(self, out=None):
         """Gets the state of the world
 
+        Reads the poses kept by the world state tracker, all at their latest common
+        stamp, only waiting if a frame has not been seen yet or is older than
+        self.max_staleness seconds. Raises ROSInterruptException on shutdown.
+        The snapshot, with the age of every frame, is kept in self.last_world_snapshot.
+        The layout of the state is given by self.state_schema, and every state is
+        also recorded in the self.state_history ring buffer.
+
+        Args:
+            out: optional np.array (width,) the state is copied into instead of a new array
+
+        Returns:
+            state: out, or a new np.array [1, width] if out is None
         """
 
-        robot = self.findPose(self.stretch_frame)
-        ee = self.findPose(self.ee_frame)
-        duck1 = self.findPose(self.duck1_frame)
-        duck2 = self.findPose(self.duck2_frame)
-
-        state = np.zeros([1, 12])
-        # state[0, 0] = robot.translation.x
-        # state[0, 1] = robot.translation.y
-        # state[0, 2] = findTheta(robot)
-        # state[0, 3] = ee.translation.x
-        # state[0, 4] = ee.translation.y
-        # state[0, 5] = ee.translation.z
-        # state[0, 6] = duck1.translation.x
-        # state[0, 7] = duck1.translation.y
-        # state[0, 8] = duck1.translation.z
-        # state[0, 9] = duck2.translation.x
-        # state[0, 10] = duck2.translation.y
-        # state[0, 11] = duck2.translation.z
-        state[0, 0] = robot.translation.x
-        state[0, 1] = robot.translation.y
-        state[0, 2] = ee.translation.x
-        state[0, 3] = ee.translation.y
-        state[0, 4] = ee.translation.z
-        state[0, 5] = duck1.translation.x
-        state[0, 6] = duck1.translation.y
-        state[0, 7] = duck1.translation.z
-        state[0, 8] = duck2.translation.x
-        state[0, 9] = duck2.translation.y
-        state[0, 10] = duck2.translation.z
-
-        return state
+        snapshot = self.world_state_tracker.waitForSnapshot(self.max_staleness)
+        if snapshot is None:
+            raise rospy.ROSInterruptException("Shut down while waiting for the world state")
+        self.last_world_snapshot = snapshot
+        row = self.state_history.nextRow(snapshot.stamp.to_sec())
+        self.state_schema.fill(row, snapshot.transforms[self.stretch_frame], snapshot.transforms[self.ee_frame],
+                               [snapshot.transforms[frame] for frame in self.state_schema.object_frames])
+
+        if out is None:
+            return row[np.newaxis, :].copy()
+        out[:] = row
+        return out
 
     def joint_states_callback(self, joint_states):
-        with self.joint_states_lock:
-            self.joint_states = joint_states
-        wrist_position, wrist_velocity, wrist_effort = hm.get_wrist_state(joint_states)
-        self.wrist_position = wrist_position
-        lift_position, lift_velocity, lift_effort = hm.get_lift_state(joint_states)
-        self.lift_position = lift_position
-        wrist_yaw_position, wrist_yaw_velocity, wrist_yaw_effort = get_wrist_yaw_state(joint_states)
-        self.wrist_yaw_position = wrist_yaw_position
+        self.joint_state_store.update(joint_states)
 
     def openGripper(self, obj_name=None):
         if DO_MOVE_GRIPPER:
@@ -213,6 +271,7 @@ class StretchSkill(hm.HelloNode):
             rospy.loginfo("Global parameter set to not move gripper")
 
     def attachObject(self, obj_name):
+        from gazebo_ros_link_attacher.srv import AttachRequest
         rospy.loginfo("Attaching gripper and {}".format(obj_name))
         req = AttachRequest()
         req.model_name_1 = "robot"
@@ -223,6 +282,7 @@ class StretchSkill(hm.HelloNode):
         self.attach_srv.call(req)
 
     def detachObject(self, obj_name):
+        from gazebo_ros_link_attacher.srv import AttachRequest
         rospy.loginfo("Detaching gripper and {}".format(obj_name))
         req = AttachRequest()
         req.model_name_1 = "robot"
@@ -234,11 +294,13 @@ class StretchSkill(hm.HelloNode):
 
     def findPose(self, frame):
         #TODO Change this to not be a class function, but pass in the transform or something?
+        # The latest transform is used, frames that do not move are only republished every
+        # keepalive period, so waiting for one at the current time would block for up to that long
         found_transform = False
         cnt = 1
         while not found_transform:
             try:
-                trans_stamped = self.tfBuffer.lookup_transform(self.origin_frame, frame, rospy.Time.now(), rospy.Duration(1.0))
+                trans_stamped = self.tfBuffer.lookup_transform(self.origin_frame, frame, rospy.Time(0), rospy.Duration(1.0))
                 trans = trans_stamped.transform
                 found_transform = True
             except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
@@ -250,6 +312,15 @@ class StretchSkill(hm.HelloNode):
 
         return trans
 
+    def getLatestBasePose(self):
+        """ Returns the latest pose of the base from the world state tracker without
+        waiting, None if it has not been seen or is older than self.max_pose_staleness
+        """
+        trans, stamp = self.world_state_tracker.getPose(self.stretch_frame)
+        if trans is None or frameAge(rospy.Time.now(), stamp) > self.max_pose_staleness:
+            return None
+        return trans
+
     def getRobotState(self):
         robot = self.findPose(self.stretch_frame)
         joints = self.getJointValues()
@@ -264,19 +335,33 @@ class StretchSkill(hm.HelloNode):
 
     def getJointValues(self):
         # Returns extension, lift, wrist yaw
+        joint_values, _ = self.joint_state_store.getArmState()
+        if joint_values is not None:
+            return joint_values
+        joint_values, _ = self.joint_state_store.waitForArmState()
+        if joint_values is not None:
+            return joint_values
         if IS_SIM:
-            move_group_arm = moveit_commander.MoveGroupCommander("stretch_arm")
-            joint_values = move_group_arm.get_current_joint_values()
+            rospy.logwarn("No joint states received, reading the joint values from MoveIt")
+            joint_values = self.move_group_arm.get_current_joint_values()
             return np.array([np.sum(joint_values[1:5]), joint_values[0], joint_values[5]])
         else:
-            return np.array([self.wrist_position, self.lift_position, self.wrist_yaw_position])
+            rospy.logwarn("No joint states received")
+            return np.full([3], np.nan)
 
-    def followTrajectory(self, data, teleport=TELEPORT, cart_traj=False):
+    def followTrajectory(self, data, teleport=TELEPORT, cart_traj=False, stream_arm=False, concurrent=False, arm_start_distance=0.2, track_base=False):
         # Data should be a numpy array with x, y, theta, wrist_extension, z, wrist_theta
         rospy.loginfo("Starting followTrajectory with teleport={}".format(teleport))
         rospy.loginfo("Trajectory: {}".format(data))
 
-        traj_log = np.zeros([data.shape[0], 12])
+        if track_base and not teleport:
+            return self.followTrajectoryTracked(data, cart_traj=cart_traj)
+        if stream_arm:
+            return self.followTrajectoryStreamed(data, teleport=teleport, cart_traj=cart_traj)
+        if concurrent:
+            return self.followTrajectoryConcurrent(data, teleport=teleport, cart_traj=cart_traj, arg_arm_start_distance=arm_start_distance)
+
+        traj_log = np.zeros([data.shape[0], self.state_schema.width])
         for ii, d in enumerate(data):
 
             if d[0] != -10:
@@ -292,23 +377,11 @@ class StretchSkill(hm.HelloNode):
             theta = findTheta(trans_stretch)
 
             if cart_traj:
-                reset_cnt = 0
-                amount_to_extend = np.nan
-                test_theta_array = np.linspace(0, 2 * np.pi, 1000)
-                zeroones = np.empty((1000,))
-                zeroones[::2] = 1
-                zeroones[1::2] = -1
-                test_theta_array = np.multiply(test_theta_array, zeroones)
-                for test_theta_offset in test_theta_array:
-                    robot_theta = theta + test_theta_offset
-                    arm_origin_x = d[0] + 0.14 * np.cos(robot_theta) - 0.16 * (- np.sin(robot_theta))
-                    arm_origin_y = d[1] + 0.14 * np.sin(robot_theta) - 0.16 * np.cos(robot_theta)
-                    goal_pose = Transform()
-                    goal_pose.translation.x = d[2]
-                    goal_pose.translation.y = d[3]
-                    amount_to_extend, wrist_theta = findArmExtensionAndRotation(goal_pose, arm_origin_x, arm_origin_y, robot_theta)
-                    if robot_theta < 2 * np.pi and not np.isnan(amount_to_extend):
-                        break
+                # All candidate headings are evaluated at once, the closest reachable one to theta is chosen
+                if self.reach_map is not None:
+                    amount_to_extend, wrist_theta, robot_theta = self.reach_map.query(d[0], d[1], d[2], d[3], theta)
+                else:
+                    amount_to_extend, wrist_theta, robot_theta = findHeadingArmExtensionAndRotation(d[0], d[1], d[2], d[3], theta)
                 if robot_theta != theta:
                     print("rotate to theta: ", robot_theta)
                     self.rotateToTheta(robot_theta)
@@ -319,7 +392,7 @@ class StretchSkill(hm.HelloNode):
 
             # rospy.loginfo("Robot is at: x: {:.3f}, y: {:.3f}, theta: {:.3f}".format(trans_stretch.translation.x, trans_stretch.translation.y, theta))
 
-            traj_log[ii, :] = self.getWorldState()
+            self.getWorldState(out=traj_log[ii, :])
 
         rospy.loginfo("Completed followTrajectory")
         rospy.loginfo("Robot is at: x: {:.3f}, y: {:.3f}, theta: {:.3f}".format(trans_stretch.translation.x, trans_stretch.translation.y, theta))
@@ -329,24 +402,334 @@ class StretchSkill(hm.HelloNode):
 
         return traj_log
 
-    def rotateToTheta(self, arg_goal_theta, arg_close_enough=0.05):
-        make_theta_correction = True
-        while make_theta_correction:
+    def followTrajectoryStreamed(self, data, teleport=TELEPORT, cart_traj=False, arg_close_enough=0.1):
+        """ Same as followTrajectory, but every run of waypoints that share a base
+        pose is sent to the arm as one streamed trajectory instead of stopping at
+        each waypoint. The world state is logged by a separate thread as the arm
+        reaches each waypoint, so the action feedback is never blocked. Cartesian
+        waypoints the arm cannot reach hold the previous joint values.
+        """
+        traj_log = np.zeros([data.shape[0], self.state_schema.width])
+        ii = 0
+        while ii < data.shape[0]:
+            d = data[ii]
+            if d[0] != -10:
+                if cart_traj:
+                    self.visitWaypoint(np.array([d[0], d[1], -10]), teleport=teleport)
+                else:
+                    self.visitWaypoint(d[:3], teleport=teleport)
+
+            if DO_THETA_CORRECTION and d[2] != -10 and not teleport and cart_traj == False:
+                self.rotateToTheta(d[2])
+
+            # Waypoints after ii whose base pose is close enough to this one are executed by the arm only
+            jj = ii + 1
+            while jj < data.shape[0] and (data[jj, 0] == -10 or (np.hypot(data[jj, 0] - d[0], data[jj, 1] - d[1]) < arg_close_enough and
+                                                               (cart_traj or data[jj, 2] == -10 or data[jj, 2] == d[2]))):
+                jj += 1
+            run = data[ii:jj]
+
             trans_stretch = self.findPose(STRETCH_FRAME)
             theta = findTheta(trans_stretch)
+            if cart_traj:
+                if self.reach_map is not None:
+                    _, _, robot_theta = self.reach_map.query(d[0], d[1], d[2], d[3], theta)
+                else:
+                    _, _, robot_theta = findHeadingArmExtensionAndRotation(d[0], d[1], d[2], d[3], theta)
+                if robot_theta != theta:
+                    rospy.logdebug("Rotating to theta: {:.3f}".format(robot_theta))
+                    self.rotateToTheta(robot_theta)
+                # The run ends at the first waypoint that needs a different heading
+                amount_to_extend, wrist_theta, headings = findHeadingArmExtensionAndRotation(run[:, 0], run[:, 1], run[:, 2], run[:, 3], robot_theta)
+                n_same = np.argmax(np.append(headings != robot_theta, True))
+                run_arm = np.column_stack([amount_to_extend, run[:, 4] - 0.1, wrist_theta])[:max(n_same, 1)]
+            else:
+                run_arm = run[:, 3:6]
+
+            n_logged = 0
+            log_lock = threading.Lock()
+
+            def log_progress(n_reached):
+                nonlocal n_logged
+                with log_lock:
+                    while n_logged < min(n_reached, run_arm.shape[0]):
+                        self.getWorldState(out=traj_log[ii + n_logged, :])
+                        n_logged += 1
+
+            stream_done = threading.Event()
+
+            def log_loop():
+                rate = rospy.Rate(50.0)
+                while not stream_done.is_set() and not rospy.is_shutdown():
+                    log_progress(self.arm_stream_progress)
+                    rate.sleep()
+
+            self.arm_stream_progress = 0
+            logger = threading.Thread(target=log_loop)
+            logger.start()
+            self.streamArmTrajectory(run_arm)
+            stream_done.set()
+            logger.join()
+            log_progress(run_arm.shape[0])
+            ii += run_arm.shape[0]
+
+        rospy.loginfo("Completed followTrajectory")
+
+        return traj_log
+
+    def followTrajectoryConcurrent(self, data, teleport=TELEPORT, cart_traj=False, arg_arm_start_distance=0.2):
+        """ Same as followTrajectory, but the base and the arm move at the same time
+
+        For every waypoint the base drives (and rotates) in a separate thread while
+        the arm waits until the base is within arg_arm_start_distance of the
+        waypoint, then moves. With arg_arm_start_distance None the arm starts right
+        away. The arm targets of cartesian trajectories are solved for the base
+        waypoint rather than the current base pose, and the base rotates to the
+        heading they were solved for after driving. The start and end times of every
+        waypoint are kept in self.waypoint_status.
+        """
+        traj_log = np.zeros([data.shape[0], self.state_schema.width])
+        self.waypoint_status = []
+        rate = rospy.Rate(50.0)
+        for ii, d in enumerate(data):
+            status = {'waypoint': ii, 'start': time.time()}
+            self.waypoint_status.append(status)
+
+            trans_stretch = self.findPose(STRETCH_FRAME)
+            theta = findTheta(trans_stretch)
+            goal_theta = None
+            if cart_traj:
+                if self.reach_map is not None:
+                    amount_to_extend, wrist_theta, robot_theta = self.reach_map.query(d[0], d[1], d[2], d[3], theta)
+                else:
+                    amount_to_extend, wrist_theta, robot_theta = findHeadingArmExtensionAndRotation(d[0], d[1], d[2], d[3], theta)
+                # Driving changes the heading, so the base always turns back to the heading the arm goal is solved for
+                if robot_theta != theta or d[0] != -10:
+                    goal_theta = robot_theta
+                arm_goal = np.array([amount_to_extend, d[4] - 0.1, wrist_theta])
+            else:
+                if DO_THETA_CORRECTION and d[2] != -10 and not teleport:
+                    goal_theta = d[2]
+                arm_goal = d[3:]
+
+            def move_base():
+                if d[0] != -10:
+                    if cart_traj:
+                        self.visitWaypoint(np.array([d[0], d[1], -10]), teleport=teleport)
+                    else:
+                        self.visitWaypoint(d[:3], teleport=teleport)
+                if goal_theta is not None:
+                    self.rotateToTheta(goal_theta)
+                status['base_done'] = time.time()
+
+            base_thread = threading.Thread(target=move_base)
+            base_thread.start()
+
+            # Synchronization policy: the arm starts once the base is close enough to the waypoint
+            while d[0] != -10 and arg_arm_start_distance is not None and base_thread.is_alive() and not rospy.is_shutdown():
+                robot, _ = self.world_state_tracker.getPose(self.stretch_frame)
+                if robot is not None and np.hypot(d[0] - robot.translation.x, d[1] - robot.translation.y) < arg_arm_start_distance:
+                    break
+                rate.sleep()
+
+            status['arm_start'] = time.time()
+            self.moveArm(arm_goal)
+            status['arm_done'] = time.time()
+            base_thread.join()
+            status['done'] = time.time()
+
+            self.getWorldState(out=traj_log[ii, :])
+
+        rospy.loginfo("Completed followTrajectory in {:.2f} s".format(time.time() - self.waypoint_status[0]['start'] if self.waypoint_status else 0))
+
+        return traj_log
+
+    def followTrajectoryTracked(self, data, cart_traj=False):
+        """ Same as followTrajectory, but the base follows the whole base path with
+        followBasePath instead of stopping at every waypoint
+
+        The base drives in a separate thread. The arm moves to each waypoint once
+        the base has passed it, and the world state is logged after. Cartesian
+        waypoints are solved with the same heading search as followTrajectory.
+        A waypoint that needs another heading waits for the base to finish its
+        path, then the base rotates as in followTrajectory. Waypoints unreachable
+        from any heading keep the previous arm pose, and are logged and kept in
+        self.skipped_waypoints since the symbols they visit may differ from the
+        planned ones. The last waypoint is done as in followTrajectory, so the
+        skill ends in the same pose. The tracking error metrics are kept in
+        self.path_tracking_metrics.
+        """
+        traj_log = np.zeros([data.shape[0], self.state_schema.width])
+        has_base = data[:, 0] != -10
+        base_path = data[has_base, :2]
+        # Index on the base path of the last base waypoint at or before each waypoint
+        base_idx = np.cumsum(has_base) - 1
+        self.base_path_progress = -1
+        self.skipped_waypoints = []
+
+        def on_progress(closest_idx):
+            self.base_path_progress = closest_idx
+
+        def solve(d):
+            trans_stretch = self.findPose(STRETCH_FRAME)
+            theta = findTheta(trans_stretch)
+            if self.reach_map is not None:
+                amount_to_extend, wrist_theta, robot_theta = self.reach_map.query(trans_stretch.translation.x, trans_stretch.translation.y, d[2], d[3], theta)
+            else:
+                amount_to_extend, wrist_theta, robot_theta = findHeadingArmExtensionAndRotation(trans_stretch.translation.x, trans_stretch.translation.y, d[2], d[3], theta)
+            return amount_to_extend, wrist_theta, robot_theta, theta
+
+        base_thread = None
+        if base_path.shape[0] > 0:
+            base_thread = threading.Thread(target=self.followBasePath, args=(base_path,), kwargs={'progress_cb': on_progress})
+            base_thread.start()
+
+        for ii, d in enumerate(data[:-1]):
+            while base_thread is not None and base_thread.is_alive() and self.base_path_progress < base_idx[ii] and not rospy.is_shutdown():
+                self.rate.sleep()
+
+            if cart_traj:
+                amount_to_extend, wrist_theta, robot_theta, theta = solve(d)
+                if not np.isnan(amount_to_extend) and robot_theta != theta and base_thread is not None and base_thread.is_alive():
+                    # The base cannot rotate while it follows the path
+                    rospy.logwarn("Waypoint {} needs heading {:.2f}, waiting for the base to finish its path".format(ii, robot_theta))
+                    base_thread.join()
+                    amount_to_extend, wrist_theta, robot_theta, theta = solve(d)
+                if not np.isnan(amount_to_extend):
+                    if robot_theta != theta:
+                        self.rotateToTheta(robot_theta)
+                    self.moveArm(np.array([amount_to_extend, d[4] - 0.1, wrist_theta]))
+                else:
+                    rospy.logwarn("Waypoint {} is unreachable from any heading, keeping the previous arm pose".format(ii))
+                    self.skipped_waypoints.append(ii)
+            else:
+                self.moveArm(d[3:])
+
+            self.getWorldState(out=traj_log[ii, :])
+
+        if base_thread is not None:
+            base_thread.join()
+
+        d = data[-1]
+        if DO_THETA_CORRECTION and d[2] != -10 and cart_traj == False:
+            self.rotateToTheta(d[2])
+        trans_stretch = self.findPose(STRETCH_FRAME)
+        theta = findTheta(trans_stretch)
+        if cart_traj:
+            if self.reach_map is not None:
+                amount_to_extend, wrist_theta, robot_theta = self.reach_map.query(d[0], d[1], d[2], d[3], theta)
+            else:
+                amount_to_extend, wrist_theta, robot_theta = findHeadingArmExtensionAndRotation(d[0], d[1], d[2], d[3], theta)
+            if robot_theta != theta:
+                self.rotateToTheta(robot_theta)
+            self.moveArm(np.array([amount_to_extend, d[4] - 0.1, wrist_theta]))
+        else:
+            self.moveArm(d[3:])
+        self.getWorldState(out=traj_log[-1, :])
+
+        if self.skipped_waypoints:
+            rospy.logwarn("Skipped {} of {} waypoints: {}".format(len(self.skipped_waypoints), data.shape[0], self.skipped_waypoints))
+        rospy.loginfo("Completed followTrajectory")
+
+        return traj_log
+
+    def streamArmTrajectory(self, arg_ext_lift_yaw, feedback_cb=None, wait=True):
+        """ Sends a whole arm trajectory as one FollowJointTrajectory goal
+
+        The arm moves through the waypoints without stopping. Each segment is timed
+        by the slowest joint at ARM_MAX_VEL, and at least ARM_MIN_DT. Entries of -10
+        hold the previous value of that joint, as in moveArm, and so do nan entries
+        from unreachable cartesian waypoints. Segments from unknown current joint
+        values take ARM_MIN_DT, and nothing is sent if a joint to hold is unknown.
+
+        Args:
+            arg_ext_lift_yaw: np.array [N, 3] with extension, lift and wrist yaw
+            feedback_cb: called with (number of waypoints reached, feedback) as the arm moves
+            wait: block until the arm finishes
+
+        Returns:
+            result of the action if wait is True, None if nothing was sent
+        """
+        traj = np.array(arg_ext_lift_yaw, dtype=float, ndmin=2)
+        n_unreachable = np.sum(np.any(np.isnan(traj), axis=1))
+        if n_unreachable > 0:
+            rospy.logwarn("{} of {} arm waypoints are unreachable, holding the previous joint values".format(n_unreachable, traj.shape[0]))
+        current = self.getJointValues()
+        previous = current
+        for row in traj:
+            hold = (row == -10) | np.isnan(row)
+            row[hold] = previous[hold]
+            previous = row
+        if not np.all(np.isfinite(traj)):
+            rospy.logerr("Joint values to hold are unknown, not sending the arm trajectory")
+            self.arm_stream_progress = 0
+            return None
+        if IS_SIM:
+            traj[:, 0] = np.clip(traj[:, 0], 0, 0.5)
+            traj[:, 1] = np.clip(traj[:, 1], 0, 1)
+
+        with np.errstate(invalid='ignore'):
+            joint_dt = np.max(np.abs(np.diff(np.vstack([current, traj]), axis=0)) / ARM_MAX_VEL, axis=1)
+        segment_dt = np.maximum(np.where(np.isfinite(joint_dt), joint_dt, ARM_MIN_DT), ARM_MIN_DT)
+        time_from_start = np.cumsum(segment_dt)
+
+        goal = FollowJointTrajectoryGoal()
+        goal.trajectory.joint_names = ARM_JOINT_NAMES
+        for row, t in zip(traj, time_from_start):
+            point = JointTrajectoryPoint()
+            if IS_SIM:
+                point.positions = [row[1], row[0]/4, row[0]/4, row[0]/4, row[0]/4, row[2]]
+            else:
+                point.positions = [row[0], row[1], row[2]]
+            point.time_from_start = rospy.Duration(t)
+            goal.trajectory.points.append(point)
+        goal.trajectory.header.stamp = rospy.Time.now()
+
+        self.arm_stream_progress = 0
+
+        def on_feedback(feedback):
+            n_reached = int(np.searchsorted(time_from_start, feedback.desired.time_from_start.to_sec() + 1e-6, side='right'))
+            if n_reached > self.arm_stream_progress:
+                self.arm_stream_progress = n_reached
+                if feedback_cb is not None:
+                    feedback_cb(n_reached, feedback)
+
+        rospy.loginfo("Streaming {} arm waypoints over {:.2f} s".format(traj.shape[0], time_from_start[-1]))
+        if not IS_SIM:
+            with self.move_lock:
+                self.arm_trajectory_client.send_goal(goal, feedback_cb=on_feedback)
+                if wait:
+                    self.arm_trajectory_client.wait_for_result()
+        else:
+            self.arm_trajectory_client.send_goal(goal, feedback_cb=on_feedback)
+            if wait:
+                self.arm_trajectory_client.wait_for_result()
+        if wait:
+            self.arm_stream_progress = traj.shape[0]
+            return self.arm_trajectory_client.get_result()
+
+    def rotateToTheta(self, arg_goal_theta, arg_close_enough=0.05):
+        def step():
+            trans_stretch = self.getLatestBasePose()
+            if trans_stretch is None:
+                self.vel_pub.publish(Twist())
+                return False
+            theta = findTheta(trans_stretch)
             cmd_w = arg_goal_theta - theta
             if cmd_w >= np.pi:
                 cmd_w -= 2 * np.pi
             if cmd_w < -np.pi:
                 cmd_w += 2 * np.pi
             if np.abs(cmd_w) < arg_close_enough:
-                make_theta_correction = False
-            else:
-                rospy.loginfo("rotating to theta cmd_v: {} cmd_w: {}".format(0, cmd_w))
-                vel_msg = Twist()
-                vel_msg.angular.z = cmd_w
-                self.vel_pub.publish(vel_msg)
-                self.rate.sleep()
+                return True
+            vel_msg = Twist()
+            vel_msg.angular.z = cmd_w
+            self.vel_pub.publish(vel_msg)
+            return False
+
+        rospy.loginfo("Rotating to theta: {:.2f}".format(arg_goal_theta))
+        self.base_control_loop.run(step)
+        rospy.loginfo("Rotation control loop: {}".format(self.base_control_loop.stats))
 
         return True
 
@@ -358,35 +741,114 @@ class StretchSkill(hm.HelloNode):
             rospy.sleep(0.05)
             return True
 
-        at_waypoint = False
-        while not at_waypoint:
-            trans_stretch = self.findPose(STRETCH_FRAME)
-            theta = findTheta(trans_stretch)
+        def step():
+            trans_stretch = self.getLatestBasePose()
+            if trans_stretch is None:
+                self.vel_pub.publish(Twist())
+                return False
             dist_to_waypoint = np.sqrt([np.square(waypoint_xytheta[0] - trans_stretch.translation.x) +
                                         np.square(waypoint_xytheta[1] - trans_stretch.translation.y)])[0]
-            # rospy.loginfo("Robot is at: x: {:.3f}, y: {:.3f}, theta: {:.3f}, error: {:.3f}".format(trans_stretch.translation.x, trans_stretch.translation.y, theta, dist_to_waypoint))
+            # rospy.loginfo("Robot is at: x: {:.3f}, y: {:.3f}, error: {:.3f}".format(trans_stretch.translation.x, trans_stretch.translation.y, dist_to_waypoint))
 
             if dist_to_waypoint < arg_close_enough:
                 return True
 
-            if not at_waypoint:
-                cmd_vx, cmd_vy, theta = findCommands(trans_stretch, waypoint_xytheta)
+            cmd_vx, cmd_vy, theta = findCommands(trans_stretch, waypoint_xytheta)
+            cmd_v, cmd_w = feedbackLin(cmd_vx, cmd_vy, theta, arg_epsilon)
+            cmd_v, cmd_w = thresholdVel(cmd_v, cmd_w, arg_maxV, arg_wheel2center)
 
-                # print("cmd_vx: {} cmd_vy: {}".format(cmd_vx, cmd_vy))
-                cmd_v, cmd_w = feedbackLin(cmd_vx, cmd_vy, theta, arg_epsilon)
-                # rospy.loginfo("cmd_v: {} cmd_w: {}".format(cmd_v, cmd_w))
-                cmd_v, cmd_w = thresholdVel(cmd_v, cmd_w, arg_maxV, arg_wheel2center)
-                # rospy.loginfo("cmd_v: {} cmd_w: {} thresholded".format(cmd_v, cmd_w))
-                # _, cmd_v, cmd_w = calc_control_command(cmd_vx, cmd_vy, theta, epsilon)
+            vel_msg = Twist()
+            vel_msg.linear.x = cmd_v
+            vel_msg.angular.z = cmd_w
+            self.vel_pub.publish(vel_msg)
+            return False
 
-                vel_msg = Twist()
-                vel_msg.linear.x = cmd_v
-                vel_msg.angular.z = cmd_w
-                self.vel_pub.publish(vel_msg)
-                self.rate.sleep()
+        self.base_control_loop.run(step)
+        rospy.logdebug("Waypoint control loop: {}".format(self.base_control_loop.stats))
 
         return True
 
+    def followBasePath(self, path_xy, arg_lookahead=0.3, arg_window=20, arg_close_enough=0.1, arg_epsilon=0.1, arg_maxV=0.1, arg_wheel2center=0.1778, progress_cb=None,
+                       arg_timeout=None):
+        """ Follows a whole base path with pure pursuit instead of stopping at every point
+
+        Every cycle the base is driven at arg_maxV towards the point arg_lookahead
+        ahead of it on the path (see findLookaheadPoint), with the same feedback
+        linearization and velocity threshold as visitWaypoint. Repeated consecutive
+        points are followed once. Only the last point has to be reached within
+        arg_close_enough, once it is within the search window.
+
+        Args:
+            path_xy: np.array [N, 2]
+            arg_window: number of points ahead of the last closest point searched every cycle
+            progress_cb: called with the index in path_xy of the closest path point every cycle
+            arg_timeout: seconds, by default three times the path length at arg_maxV plus 10 s
+
+        Returns:
+            metrics: dict with the max, mean and rms cross track error, the final
+                error and the duration, also kept in self.path_tracking_metrics
+        """
+        path_xy = np.array(path_xy, dtype=float, ndmin=2)[:, :2]
+        n_points = path_xy.shape[0]
+        keep = np.append(True, np.any(np.diff(path_xy, axis=0) != 0, axis=1))
+        # Index in the input path of the last repeat of each kept point
+        last_repeat = np.append(np.flatnonzero(keep)[1:] - 1, n_points - 1)
+        path_xy = path_xy[keep]
+        if arg_timeout is None:
+            arg_timeout = 3 * np.sum(np.hypot(*np.diff(path_xy, axis=0).T)) / arg_maxV + 10.0
+        rospy.loginfo("Following base path of {} points to: x: {:.2f}, y: {:.2f}".format(path_xy.shape[0], path_xy[-1, 0], path_xy[-1, 1]))
+        start_time = time.time()
+        progress = {'closest_idx': 0, 'final_error': np.inf}
+        errors = []
+
+        def step():
+            trans_stretch = self.getLatestBasePose()
+            if trans_stretch is None:
+                self.vel_pub.publish(Twist())
+                return False
+            robot_xy = np.array([trans_stretch.translation.x, trans_stretch.translation.y])
+            target_xy, closest_idx, cross_track_error = findLookaheadPoint(path_xy, robot_xy, progress['closest_idx'], arg_lookahead, arg_window)
+            progress['closest_idx'] = closest_idx
+            errors.append(cross_track_error)
+            if progress_cb is not None:
+                progress_cb(int(last_repeat[closest_idx]))
+
+            final_error = np.hypot(path_xy[-1, 0] - robot_xy[0], path_xy[-1, 1] - robot_xy[1])
+            progress['final_error'] = final_error
+            if (arg_window is None or closest_idx + arg_window >= path_xy.shape[0]) and final_error < arg_close_enough:
+                if progress_cb is not None:
+                    progress_cb(n_points - 1)
+                return True
+
+            # Steady speed towards the lookahead point, slowing down only near the end of the path
+            cmd_vx, cmd_vy, theta = findCommands(trans_stretch, target_xy)
+            scale = min(arg_maxV, final_error) / max(np.hypot(cmd_vx, cmd_vy), 1e-6)
+            cmd_v, cmd_w = feedbackLin(cmd_vx * scale, cmd_vy * scale, theta, arg_epsilon)
+            cmd_v, cmd_w = thresholdVel(cmd_v, cmd_w, arg_maxV, arg_wheel2center)
+
+            vel_msg = Twist()
+            vel_msg.linear.x = cmd_v
+            vel_msg.angular.z = cmd_w
+            self.vel_pub.publish(vel_msg)
+            return False
+
+        if not self.base_control_loop.run(step, timeout=arg_timeout):
+            rospy.logwarn("Stopped following the base path after {:.1f} s, {:.2f} m from its end".format(arg_timeout, progress['final_error']))
+        self.vel_pub.publish(Twist())
+        final_error = progress['final_error']
+        errors = np.array(errors) if errors else np.full([1], np.nan)
+        self.path_tracking_metrics = {
+            'max_error': float(np.max(errors)),
+            'mean_error': float(np.mean(errors)),
+            'rms_error': float(np.sqrt(np.mean(np.square(errors)))),
+            'final_error': float(final_error),
+            'duration': time.time() - start_time,
+            'control_loop': self.base_control_loop.stats,
+        }
+        rospy.loginfo("Base path tracking: {}".format(self.path_tracking_metrics))
+
+        return self.path_tracking_metrics
+
     def moveArm(self, arg_desired_ext_lift_yaw):
         dl = arg_desired_ext_lift_yaw.tolist()
         # rospy.loginfo("Moving gripper and arm to: extension: {:.2f}, lift: {:.2f}, rotation: {:.2f}".format(arg_desired_ext_lift_yaw[0], arg_desired_ext_lift_yaw[1], arg_desired_ext_lift_yaw[2]))
@@ -440,22 +902,52 @@ class StretchSkill(hm.HelloNode):
         print("Goal robot pose: {}".format(end_robot))
         # split_skill_name = skill_name.split("_")[0]
         traj_cartesian = findTrajectoryFromDMP(inp_robot, end_robot, skill_name, dmp_folder, opts)
-        fig, ax = create_ax_array(2, ncols=1)
-        # plot_limits = np.array([[-2.25, 3], [-2.25, 2.25], [0, 1.25]])
-        plot_limits = np.array([[-2.25, 3], [-2.25, 2.25]])
-        apply_plot_limits(ax[0], plot_limits)
-        trajectories_ee = traj_cartesian[:, 2:]
-        trajectories_base = np.zeros([traj_cartesian.shape[0], 3])
-        trajectories_base[:, :2] = traj_cartesian[:, :2]
-        plot_trajectory(trajectories_ee, ax[0], color='red')
-        plot_trajectory(trajectories_base, ax[0], color='blue')
-        for sym in symbols:
-            symbols[sym].plot(ax[0], dim=2, alpha=0.05)
-
-        plt.savefig('/home/adam/catkin_ws/src/stretch_skill_repair/' + skill_name + ".png")
+        if self.plot_renderer is not None:
+            self.plot_renderer.plot(skill_name, traj_cartesian)
 
         return traj_cartesian
 
+    def find_valid_skill_trajectory(self, skill_name, inp_state, inp_robot, state_number, skills, symbols, state_def, next_states, dmp_folder, opts, n_candidates=8, select='first', strategy=None):
+        """ Samples n_candidates goal poses for a skill, rolls out all of their DMP
+        trajectories in one batch and checks each of them against the strategy.
+
+        Args:
+            select: 'first' returns the first valid candidate, 'shortest' the valid
+                candidate with the shortest base and end effector path
+            strategy: CompiledStrategy used to check the candidates, if given
+
+        Returns:
+            traj_cartesian: np.array, None if no candidate is valid
+            next_state_number: state the trajectory ends in, -1 if no candidate is valid
+            next_skill: skill returned by update_state, "" if no candidate is valid
+        """
+        end_robots = np.vstack([np.reshape(skills[skill_name].get_final_robot_pose(inp_robot, inp_state, symbols), [1, -1]) for _ in range(n_candidates)])
+        trajs_cartesian = findTrajectoriesFromDMP(inp_robot, end_robots, skill_name, dmp_folder, opts)
+
+        valid = []
+        for ii, intermediate_states_symbolic in enumerate(find_intermediate_symbols_batch(trajs_cartesian, symbols)):
+            next_state_number, next_skill = update_state(intermediate_states_symbolic, state_number, skill_name, state_def, next_states, arg_strategy=strategy, verbose=False)
+            if next_state_number == -1:
+                continue
+            valid.append((ii, next_state_number, next_skill))
+            if select == 'first':
+                break
+        rospy.loginfo("{} of {} candidate trajectories for {} are valid".format(len(valid), n_candidates, skill_name))
+
+        if not valid:
+            return None, -1, ""
+
+        if select == 'shortest':
+            path_lengths = np.sum(np.linalg.norm(np.diff(trajs_cartesian[:, :, :4], axis=1), axis=2), axis=1)
+            valid.sort(key=lambda v: path_lengths[v[0]])
+        ii, next_state_number, next_skill = valid[0]
+        traj_cartesian = trajs_cartesian[ii]
+
+        if self.plot_renderer is not None:
+            self.plot_renderer.plot(skill_name, traj_cartesian)
+
+        return traj_cartesian, next_state_number, next_skill
+
     def run_skill(self, skill_name, inp_state, inp_robot, sym_state, skills, symbols, dmp_folder, opts, teleport=TELEPORT):
         """
         """
@@ -465,19 +957,8 @@ class StretchSkill(hm.HelloNode):
         print("Goal robot pose: {}".format(end_robot))
         # split_skill_name = skill_name.split("_")[0]
         traj_cartesian = findTrajectoryFromDMP(inp_robot, end_robot, skill_name, dmp_folder, opts)
-        fig, ax = create_ax_array(2, ncols=1)
-        # plot_limits = np.array([[-2.25, 3], [-2.25, 2.25], [0, 1.25]])
-        plot_limits = np.array([[-2.25, 3], [-2.25, 2.25]])
-        apply_plot_limits(ax[0], plot_limits)
-        trajectories_ee = traj_cartesian[:, 2:]
-        trajectories_base = np.zeros([traj_cartesian.shape[0], 3])
-        trajectories_base[:, :2] = traj_cartesian[:, :2]
-        plot_trajectory(trajectories_ee, ax[0], color='red')
-        plot_trajectory(trajectories_base, ax[0], color='blue')
-        for sym in symbols:
-            symbols[sym].plot(ax[0], dim=2, alpha=0.05)
-
-        plt.savefig('/home/adam/catkin_ws/src/stretch_skill_repair/' + skill_name + ".png")
+        if self.plot_renderer is not None:
+            self.plot_renderer.plot(skill_name, traj_cartesian)
 
         # traj = findJointTrajectoryFromCartesianTrajectory(traj_cartesian)
 
@@ -514,15 +995,15 @@ class StretchSkill(hm.HelloNode):
             yaw = 0
             ext = dist((duck_pose.translation.x, duck_pose.translation.y), (robot_pose.translation.x, robot_pose.translation.y)) - (0.36)
             intermediate_states = np.zeros([3, inp_state.shape[1]])
-            intermediate_states[0, :] = self.getWorldState()
+            self.getWorldState(out=intermediate_states[0, :])
             self.moveArm(np.array([ext, lift, yaw]))
-            intermediate_states[1, :] = self.getWorldState()
+            self.getWorldState(out=intermediate_states[1, :])
             if 'place' in skill_name:
                 self.openGripper(duck)
             elif 'pickup' in skill_name:
                 self.closeGripper(duck)
             self.moveArm(np.array([-10, lift+0.2, -10]))
-            intermediate_states[2, :] = self.getWorldState()
+            self.getWorldState(out=intermediate_states[2, :])
 
         return intermediate_states
 
@@ -535,6 +1016,7 @@ class StretchSkill(hm.HelloNode):
             robot_theta: radians
 
         """
+        from gazebo_msgs.msg import ModelState
         # rospy.loginfo("Teleporting to x: {:.3f} y: {:.3f} theta: {:.3f}".format(robot_x, robot_y, robot_theta))
         ms_msg = ModelState()
         ms_msg.model_name = 'robot'
@@ -545,18 +1027,12 @@ class StretchSkill(hm.HelloNode):
 
 
 def findTrajectoryFromDMP(start_pose, end_pose, skill_name, dmp_folder, opts):
-    model = DMPNN(opts['start_dimension'], 1024, opts['dimension'], opts['basis_fs']).to(DEVICE)
-    model.load_state_dict(torch.load(dmp_folder + skill_name + ".pt"))
     starts = np.zeros([1, 2, start_pose.size])
     starts[0, 0, :] = start_pose
     starts[0, 1, :] = end_pose
     rospy.loginfo("Starts {}".format(starts))
-    learned_weights = model(np_to_pgpu(starts))
-    dmp = DMP(opts['basis_fs'], opts['dt'], opts['dimension'])
-    # print("Calculating rollout")
-    learned_rollouts, _, _ = \
-        dmp.rollout_torch(torch.tensor(starts[:, 0, :]).to(DEVICE), torch.tensor(starts[:, 1, :]).to(DEVICE), learned_weights)
-    out = learned_rollouts[0, :, :].cpu().detach().numpy()
+    # The network is loaded from disk on the first call for each skill and reused afterwards
+    out = rolloutDMP(starts, skill_name, dmp_folder, opts)[0, :, :]
 
     out = np.vstack([out, end_pose])
     rospy.loginfo("Learned rollout {}".format(out))
@@ -564,27 +1040,45 @@ def findTrajectoryFromDMP(start_pose, end_pose, skill_name, dmp_folder, opts):
     return out
 
 
-def findJointTrajectoryFromCartesianTrajectory(traj_cartesian):
+def findTrajectoriesFromDMP(start_pose, end_poses, skill_name, dmp_folder, opts):
+    """ Rolls out one trajectory per row of end_poses with a single forward pass
 
-    traj_joints = np.zeros([traj_cartesian.shape[0], 6])
+    Returns:
+        trajs: np.array [N, T + 1, D], each trajectory ends with its end pose
+    """
+    n_candidates = end_poses.shape[0]
+    starts = np.zeros([n_candidates, 2, start_pose.size])
+    starts[:, 0, :] = np.reshape(start_pose, [1, -1])
+    starts[:, 1, :] = end_poses
+    rollouts = rolloutDMP(starts, skill_name, dmp_folder, opts)
+
+    return np.concatenate([rollouts, end_poses[:, np.newaxis, :]], axis=1)
+
+
+def findJointTrajectoryFromCartesianTrajectory(traj_cartesian, reach_map=None):
+    """ Finds the base pose and joint values for every waypoint of a cartesian trajectory
 
-    for ii, c in enumerate(traj_cartesian):
-        amount_to_extend = np.nan
-        wrist_theta = np.nan
-
-        robot_theta = np.pi-0.1
-        while np.isnan(amount_to_extend):
-            arm_origin_x = c[0] + 0.14 * np.cos(robot_theta) - 0.16 * (- np.sin(robot_theta))
-            arm_origin_y = c[1] + 0.14 * np.sin(robot_theta) - 0.16 * np.cos(robot_theta)
-            goal_pose = Transform()
-            goal_pose.translation.x = c[2]
-            goal_pose.translation.y = c[3]
-            amount_to_extend, wrist_theta = findArmExtensionAndRotation(goal_pose, arm_origin_x, arm_origin_y, robot_theta)
-            robot_theta += 0.05
-            if robot_theta > 2 * np.pi:
-                raise Exception("Theta too high")
-        lift = c[4] - 0.1
-        traj_joints[ii, :] = np.array([c[0], c[1], robot_theta, amount_to_extend, lift, wrist_theta])
+    The headings from pi - 0.1 up to 2 pi are searched for all waypoints at once
+    and the first one from which the end effector goal is reachable is used. If a
+    ReachabilityMap is given the reachable heading closest to pi - 0.1 is used instead.
+    """
+    if reach_map is not None:
+        amount_to_extend, wrist_theta, robot_theta = reach_map.queryBatch(
+            traj_cartesian[:, 0], traj_cartesian[:, 1], traj_cartesian[:, 2], traj_cartesian[:, 3], np.pi - 0.1)
+    else:
+        theta_offsets = np.arange(0, np.pi + 0.1, 0.05)
+        amount_to_extend, wrist_theta, robot_theta = findHeadingArmExtensionAndRotation(
+            traj_cartesian[:, 0], traj_cartesian[:, 1], traj_cartesian[:, 2], traj_cartesian[:, 3], np.pi - 0.1, theta_offsets=theta_offsets)
+    if np.any(np.isnan(amount_to_extend)):
+        raise Exception("Theta too high")
+
+    traj_joints = np.zeros([traj_cartesian.shape[0], 6])
+    traj_joints[:, 0] = traj_cartesian[:, 0]
+    traj_joints[:, 1] = traj_cartesian[:, 1]
+    traj_joints[:, 2] = robot_theta
+    traj_joints[:, 3] = amount_to_extend
+    traj_joints[:, 4] = traj_cartesian[:, 4] - 0.1
+    traj_joints[:, 5] = wrist_theta
 
     return traj_joints
 
@@ -625,15 +1119,6 @@ def plotTrajectory(arg_trajectory):
     pass
 
 
-def get_wrist_yaw_state(joint_states):
-    joint_name = 'joint_wrist_yaw'
-    i = joint_states.name.index(joint_name)
-    wrist_yaw_position = joint_states.position[i]
-    wrist_yaw_velocity = joint_states.velocity[i]
-    wrist_yaw_effort = joint_states.effort[i]
-    return [wrist_yaw_position, wrist_yaw_velocity, wrist_yaw_effort]
-
-
 def main():
 
     # Arguments/variables
@@ -648,28 +1133,40 @@ def main():
     node.setEEFrame(EE_FRAME)
     node.setStretchFrame(STRETCH_FRAME)
     node.setOriginFrame(ORIGIN_FRAME)
-    node.setDuck1Frame(DUCK1_FRAME)
-    node.setDuck2Frame(DUCK2_FRAME)
+    node.setObjectFrames(rospy.get_param("~objects", OBJECT_FRAMES))
     # node.teleport_base(-1.5, -0.05, 4.71)
     node.detachObject('duck_1')
     node.detachObject('duck_2')
     node.teleport_base(0.52, 0.5, 3.1415)
     node.moveArm(np.array([0.4, 0.85+0.01*np.random.random(1)[0], -10]))
 
+    from synthesis_based_repair.skills import load_skills_from_json
+    from synthesis_based_repair.symbols import load_symbols
+    from synthesis_based_repair.tools import json_load_wrapper
+
     file_names = json_load_wrapper(args.file_names)
     sym_opts = json_load_wrapper(args.sym_opts)
     dmp_opts = json_load_wrapper(args.dmp_opts)
 
-    symbols = load_symbols("/home/adam/repos/synthesis_based_repair/data/stretch/stretch_symbols.json")
+    file_symbols = "/home/adam/repos/synthesis_based_repair/data/stretch/stretch_symbols.json"
+    symbols = load_symbols(file_symbols)
+    # Plotting is off unless ~plot_dir is set
+    plot_dir = rospy.get_param("~plot_dir", "")
+    if plot_dir:
+        node.startPlotRenderer(file_symbols, plot_dir)
     skills = load_skills_from_json("/home/adam/repos/synthesis_based_repair/data/stretch/stretch_skills.json")
     workspace_bnds = np.array(dmp_opts["workspace_bnds"])
     dmp_folder = "/home/adam/repos/synthesis_based_repair/data/dmps/"
+    if "model_cache_mb" in dmp_opts:
+        DMP_MODEL_CACHE.setMaxBytes(dmp_opts["model_cache_mb"] * 1024 ** 2)
     file_structured_slugs = "/home/adam/repos/synthesis_based_repair/data/stretch/stretch.structuredslugs"
     file_aut = "/home/adam/repos/synthesis_based_repair/data/stretch/stretch_strategy.aut"
 
     # Load in specification
     state_variables, action_variables = parse_spec(file_structured_slugs)
-    state_def, next_states, rank_def = parse_aut(file_aut, state_variables, action_variables)
+    state_def, next_states, rank_def, strategy = parse_aut(file_aut, state_variables, action_variables, compile_strategy=True, file_cache=file_aut + ".cache.npz")
+    STARTUP.mark("symbols, skills and strategy")
+    STARTUP.report()
 
     # Find initial state
     # previous_state_number = '15'
@@ -683,7 +1180,7 @@ def main():
         rospy.loginfo("Current state: {}".format(world_state))
         syms_true = find_symbols(world_state, symbols)
         rospy.loginfo("Symbols true: {}".format(syms_true))
-        state_number = find_state_number(state_def, next_states, previous_state_number, previous_skill_full, syms_true)
+        state_number = strategy.find_state_number(previous_state_number, previous_skill_full, syms_true)
         skill_to_run_full = find_skill_to_run(next_states, state_number)
         skill_to_run = skill_to_run_full
         rospy.loginfo("Executing skill: {}".format(skill_to_run))
@@ -694,12 +1191,14 @@ def main():
             print("Robot state", robot_state)
             intermediate_states = node.run_skill(skill_to_run, world_state, robot_state, syms_true, skills, symbols, dmp_folder, dmp_opts)
 
+            rospy.loginfo("DMP model cache: {}".format(DMP_MODEL_CACHE.getStats()))
+
             intermediate_states_desired = find_intermediate_symbols(intermediate_states, symbols)
             rospy.loginfo("Intermediate states visited: ")
             for i_state in intermediate_states_desired:
                 rospy.loginfo(i_state)
 
-            previous_state_number, previous_skill = update_state(intermediate_states_desired, state_number, skill_to_run_full, state_def, next_states)
+            previous_state_number, previous_skill = update_state(intermediate_states_desired, state_number, skill_to_run_full, state_def, next_states, arg_strategy=strategy)
 
             previous_skill_full = previous_skill
         else:
@@ -722,14 +1221,17 @@ def testSkillReal():
     node.setEEFrame(EE_FRAME)
     node.setStretchFrame(STRETCH_FRAME)
     node.setOriginFrame(ORIGIN_FRAME)
-    node.setDuck1Frame(DUCK1_FRAME)
-    node.setDuck2Frame(DUCK2_FRAME)
+    node.setObjectFrames(rospy.get_param("~objects", OBJECT_FRAMES))
     node.moveArm(np.array([0, 0.85, 0]))
     node.followTrajectory(np.array([[0.52, 0.5, 3.1415, -10, -10, -10]]))
     node.rotateToTheta(3.1415)
     node.moveArm(np.array([0.4, 0.85+0.01*np.random.random(1)[0], -10]))
     rospy.sleep(2)
 
+    from synthesis_based_repair.skills import load_skills_from_json
+    from synthesis_based_repair.symbols import load_symbols
+    from synthesis_based_repair.tools import json_load_wrapper
+
     file_names = json_load_wrapper(args.file_names)
     sym_opts = json_load_wrapper(args.sym_opts)
     dmp_opts = json_load_wrapper(args.dmp_opts)
@@ -738,6 +1240,8 @@ def testSkillReal():
     skills = load_skills_from_json("/home/adam/repos/synthesis_based_repair/data/stretch/stretch_skills.json")
     workspace_bnds = np.array(dmp_opts["workspace_bnds"])
     dmp_folder = "/home/adam/repos/synthesis_based_repair/data/dmps/"
+    if "model_cache_mb" in dmp_opts:
+        DMP_MODEL_CACHE.setMaxBytes(dmp_opts["model_cache_mb"] * 1024 ** 2)
     file_structured_slugs = "/home/adam/repos/synthesis_based_repair/data/stretch/stretch.structuredslugs"
     file_aut = "/home/adam/repos/synthesis_based_repair/data/stretch/stretch_strategy.aut"
 
@@ -762,6 +1266,48 @@ def testSkillReal():
     print("Intermediate state", istates)
 
 
+def planSkill(node, skill_to_run, world_state, state_number, skills, symbols, state_def, next_states, strategy, dmp_folder, dmp_opts,
+              n_candidates=1, candidate_select="first", max_attempts=None, cancel_event=None):
+    """ Plans trajectories for a skill until one is accepted by the strategy
+
+    Args:
+        max_attempts: number of batches (or single trajectories if n_candidates is 1)
+            tried before giving up, None to keep trying
+        cancel_event: threading.Event, no further attempt is made once it is set
+
+    Returns:
+        traj_cartesian: np.array, None if no trajectory was found
+        next_state_number: state the trajectory ends in, -1 if no trajectory was found
+        next_skill: skill returned by update_state
+    """
+    robot_state = world_state[0, :5]
+    traj_cartesian, next_state_number, next_skill = None, -1, ""
+    n_attempts = 0
+    while next_state_number == -1 and (max_attempts is None or n_attempts < max_attempts) and not rospy.is_shutdown() and \
+            (cancel_event is None or not cancel_event.is_set()):
+        n_attempts += 1
+        if n_candidates > 1:
+            traj_cartesian, next_state_number, next_skill = node.find_valid_skill_trajectory(skill_to_run, world_state, robot_state, state_number, skills, symbols, state_def, next_states, dmp_folder, dmp_opts, n_candidates=n_candidates, select=candidate_select, strategy=strategy)
+        else:
+            traj_cartesian = node.find_skill_trajectory(skill_to_run, world_state, robot_state, None, skills, symbols, dmp_folder, dmp_opts)
+            intermediate_states_symbolic = find_intermediate_symbols(traj_cartesian, symbols)
+            rospy.loginfo("Trajectory would visit: ")
+            for i_state in intermediate_states_symbolic:
+                rospy.loginfo(i_state)
+            next_state_number, next_skill = update_state(intermediate_states_symbolic, state_number, skill_to_run, state_def, next_states, arg_strategy=strategy)
+        rospy.loginfo("The next state would be: {}".format(next_state_number))
+
+    return traj_cartesian, next_state_number, next_skill
+
+
+def predictWorldState(world_state, traj_cartesian):
+    """ World state at the end of a trajectory, assuming the objects do not move
+    """
+    predicted = np.array(world_state, copy=True)
+    predicted[0, :5] = traj_cartesian[-1, :5]
+    return predicted
+
+
 def runStrategyReal():
 
     # Arguments/variables
@@ -776,8 +1322,7 @@ def runStrategyReal():
     node.setEEFrame(EE_FRAME)
     node.setStretchFrame(STRETCH_FRAME)
     node.setOriginFrame(ORIGIN_FRAME)
-    node.setDuck1Frame(DUCK1_FRAME)
-    node.setDuck2Frame(DUCK2_FRAME)
+    node.setObjectFrames(rospy.get_param("~objects", OBJECT_FRAMES))
     # node.moveArm(np.array([0, 0.85, 0]))
     # node.followTrajectory(np.array([[0.52, 0.5, 3.1415, -10, -10, -10]]))
     node.followTrajectory(np.array([[0.75, 0.5, np.pi, 0.45, 0.8, 0]]))
@@ -788,20 +1333,46 @@ def runStrategyReal():
 
     rospy.loginfo("Beginning strategy execution")
 
+    from synthesis_based_repair.skills import load_skills_from_json
+    from synthesis_based_repair.symbols import load_symbols
+    from synthesis_based_repair.tools import json_load_wrapper
+
     file_names = json_load_wrapper(args.file_names)
     sym_opts = json_load_wrapper(args.sym_opts)
     dmp_opts = json_load_wrapper(args.dmp_opts)
 
-    symbols = load_symbols("/home/adam/repos/synthesis_based_repair/data/stretch/stretch_symbols.json")
+    file_symbols = "/home/adam/repos/synthesis_based_repair/data/stretch/stretch_symbols.json"
+    symbols = load_symbols(file_symbols)
+    # Plotting is off unless ~plot_dir is set
+    plot_dir = rospy.get_param("~plot_dir", "")
+    if plot_dir:
+        node.startPlotRenderer(file_symbols, plot_dir)
     skills = load_skills_from_json("/home/adam/repos/synthesis_based_repair/data/stretch/stretch_skills.json")
     workspace_bnds = np.array(dmp_opts["workspace_bnds"])
     dmp_folder = "/home/adam/repos/synthesis_based_repair/data/dmps/"
+    if "model_cache_mb" in dmp_opts:
+        DMP_MODEL_CACHE.setMaxBytes(dmp_opts["model_cache_mb"] * 1024 ** 2)
     file_structured_slugs = "/home/adam/repos/synthesis_based_repair/data/stretch/stretch.structuredslugs"
     file_aut = "/home/adam/repos/synthesis_based_repair/data/stretch/stretch_strategy.aut"
 
     # Load in specification
     state_variables, action_variables = parse_spec(file_structured_slugs)
-    state_def, next_states, rank_def = parse_aut(file_aut, state_variables, action_variables)
+    state_def, next_states, rank_def, strategy = parse_aut(file_aut, state_variables, action_variables, compile_strategy=True, file_cache=file_aut + ".cache.npz")
+    STARTUP.mark("symbols, skills and strategy")
+    STARTUP.report()
+
+    # Number of DMP trajectories sampled and checked per batch, 1 plans one trajectory at a time
+    n_candidates = dmp_opts.get("n_candidates", 1)
+    candidate_select = dmp_opts.get("candidate_select", "first")
+    # Follow the base path continuously instead of stopping at every waypoint
+    track_base = dmp_opts.get("track_base", False)
+    # Waypoints are removed before execution if they are within max_deviation of the simplified trajectory
+    max_deviation = dmp_opts.get("max_deviation", None)
+    # Plan the next skill for the predicted end state while the current one executes
+    speculative_planner = None
+    if dmp_opts.get("speculative_planning", False):
+        speculative_planner = SpeculativePlanner(tolerance=dmp_opts.get("speculative_tolerance", 0.1))
+    speculative_attempts = dmp_opts.get("speculative_attempts", 5)
 
     # Find initial state
     # previous_state_number = '14'
@@ -815,25 +1386,39 @@ def runStrategyReal():
         rospy.loginfo("Current state: {}".format(world_state))
         syms_true = find_symbols(world_state, symbols)
         rospy.loginfo("Symbols true: {}".format(syms_true))
-        state_number = find_state_number(state_def, next_states, previous_state_number, previous_skill, syms_true)
+        state_number = strategy.find_state_number(previous_state_number, previous_skill, syms_true)
         skill_to_run = find_skill_to_run(next_states, state_number)
         # skill_to_run = skill_to_run_full
         rospy.loginfo("Executing skill: {}".format(skill_to_run))
 
         if skill_to_run != " ":
-            # robot_state = node.getRobotState()
-            robot_state = world_state[0, :5]
             # intermediate_states = node.run_skill(skill_to_run, world_state, robot_state, syms_true, skills, symbols, dmp_folder, dmp_opts)
-            previous_state_number = -1
-            while previous_state_number == -1:
-                traj_cartesian = node.find_skill_trajectory(skill_to_run, world_state, robot_state, syms_true, skills, symbols, dmp_folder, dmp_opts)
-                intermediate_states_symbolic = find_intermediate_symbols(traj_cartesian, symbols)
-                rospy.loginfo("Trajectory would visit: ")
-                for i_state in intermediate_states_symbolic:
-                    rospy.loginfo(i_state)
-                previous_state_number, previous_skill = update_state(intermediate_states_symbolic, state_number, skill_to_run, state_def, next_states)
-                rospy.loginfo("The next state would be: ".format(previous_state_number))
-            intermediate_states = node.followTrajectory(traj_cartesian, teleport=False, cart_traj=True)
+            plan = speculative_planner.take(state_number, world_state) if speculative_planner is not None else None
+            if plan is not None and plan[1] != -1:
+                rospy.loginfo("Using the speculative plan, the next state would be: {}".format(plan[1]))
+                traj_cartesian, previous_state_number, previous_skill = plan
+            else:
+                traj_cartesian, previous_state_number, previous_skill = planSkill(node, skill_to_run, world_state, state_number, skills, symbols, state_def, next_states, strategy, dmp_folder, dmp_opts, n_candidates=n_candidates, candidate_select=candidate_select)
+            rospy.loginfo("DMP model cache: {}".format(DMP_MODEL_CACHE.getStats()))
+
+            if speculative_planner is not None:
+                predicted_world_state = predictWorldState(world_state, traj_cartesian)
+                predicted_state_number = strategy.find_state_number(previous_state_number, previous_skill, find_symbols(predicted_world_state, symbols))
+                # The prediction can match no successor, then nothing is planned ahead
+                predicted_skill = find_skill_to_run(next_states, predicted_state_number) if predicted_state_number != -1 else " "
+                if predicted_skill != " ":
+                    rospy.loginfo("Speculatively planning {} from state {}".format(predicted_skill, predicted_state_number))
+                    speculative_planner.start(predicted_state_number, predicted_world_state, planSkill, node, predicted_skill, predicted_world_state,
+                                              predicted_state_number, skills, symbols, state_def, next_states, strategy, dmp_folder, dmp_opts,
+                                              n_candidates=n_candidates, candidate_select=candidate_select, max_attempts=speculative_attempts)
+            if max_deviation is not None:
+                n_waypoints = traj_cartesian.shape[0]
+                traj_cartesian, _ = decimate_trajectory(traj_cartesian, symbols, max_deviation, workspace_bnds=workspace_bnds)
+                rospy.loginfo("Decimated trajectory from {} to {} waypoints, reduction ratio {:.2f}".format(
+                    n_waypoints, traj_cartesian.shape[0], 1 - traj_cartesian.shape[0] / n_waypoints))
+            intermediate_states = node.followTrajectory(traj_cartesian, teleport=False, cart_traj=True, track_base=track_base)
+            if speculative_planner is not None:
+                rospy.loginfo("Speculative planner: {}".format(speculative_planner.stats))
 
             # intermediate_states_desired = find_intermediate_symbols(intermediate_states, symbols)
             # rospy.loginfo("Intermediate states visited: ")
@@ -859,8 +1444,7 @@ if __name__ == '__main__':
         node.setEEFrame(EE_FRAME)
         node.setStretchFrame(STRETCH_FRAME)
         node.setOriginFrame(ORIGIN_FRAME)
-        node.setDuck1Frame(DUCK1_FRAME)
-        node.setDuck2Frame(DUCK2_FRAME)
+        node.setObjectFrames(rospy.get_param("~objects", OBJECT_FRAMES))
 
         # pose = node.findPose('stretch')
         # print(pose)
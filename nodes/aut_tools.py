@@ -1,8 +1,17 @@
 #!/usr/bin/env python
 import re
+import os
+import hashlib
 import sys, getopt
+import numpy as np
 
-def parse_aut(file_aut,state_variables,action_variables):
+STATE_PATTERN = re.compile(r'State\s(\d+)')
+RANK_PATTERN = re.compile(r'rank\s(.*?)\s->')
+SUCCESSOR_PATTERN = re.compile(r'\s(\d+)')
+TRUE_VARIABLE_PATTERNS = {}
+AUT_CACHE_VERSION = 1
+
+def parse_aut(file_aut,state_variables,action_variables,compile_strategy=False,file_cache=None):
     """
     Reads in an aut file and stores the data in a more workable form.
 
@@ -14,6 +23,13 @@ def parse_aut(file_aut,state_variables,action_variables):
         list of which variables are environmental variables
     action_variables:
         list of which variables are input variables
+    compile_strategy:
+        if True, also returns a CompiledStrategy
+    file_cache:
+        .npz file the parsed strategy is cached in. It is used instead of parsing
+        if it was written for the same aut file (same hash or mtime and size) and
+        the same variables, and is rewritten otherwise. A cache that cannot be
+        written is skipped with a warning.
 
     OUTPUTS
     -------
@@ -23,32 +39,194 @@ def parse_aut(file_aut,state_variables,action_variables):
         dict of states and valid action and what states come next
     rank:
         dict of rank of the states
+    strategy:
+        CompiledStrategy, only returned if compile_strategy is True
+    """
+    parsed = None
+    if file_cache is not None:
+        parsed = load_aut_cache(file_cache,file_aut,state_variables,action_variables)
+    if parsed is None:
+        parsed = parse_aut_file(file_aut,state_variables,action_variables)
+        if file_cache is not None:
+            # The cache only speeds up the next start, failing to write it is not an error
+            try:
+                write_aut_cache(file_cache,file_aut,state_variables,action_variables,*parsed)
+            except (OSError,KeyError,ValueError) as e:
+                print("Warning: could not write the strategy cache {}: {!r}".format(file_cache,e))
+    state_def,next_states,rank = parsed
+
+    if compile_strategy:
+        return state_def,next_states,rank,CompiledStrategy(state_def,next_states,state_variables)
+    return state_def,next_states,rank
+
+def parse_aut_file(file_aut,state_variables,action_variables):
+    """
+    Parses an aut file in a single pass over its lines, see parse_aut.
     """
     state_def = {}
     next_states = {}
     rank = {}
-    fid = open(file_aut,'r')
-    lines = fid.readlines()
 
     # Finds out which variables are true in each state and which actions can be taken from each state
     state = 0
-    for (idx,line) in enumerate(lines):
-        if (idx%2) == 0:
-            state_m = re.findall('State\s(\d+)',line)
-            state = state_m[0]
-            variables_true = get_true_variables(line,state_variables)
-            action_true = get_true_variables(line,action_variables)
-            rank[state] = get_rank(line)
-            if not action_true:
-                action_true = [' ']
-            state_def[state] = variables_true
-            next_states[state] = action_true
-        else:
-            successors = get_successors(line)
-            next_states[state].append(successors)
+    with open(file_aut,'r') as fid:
+        for (idx,line) in enumerate(fid):
+            if (idx%2) == 0:
+                state = STATE_PATTERN.search(line).group(1)
+                variables_true = get_true_variables(line,state_variables)
+                action_true = get_true_variables(line,action_variables)
+                rank[state] = get_rank(line)
+                if not action_true:
+                    action_true = [' ']
+                state_def[state] = variables_true
+                next_states[state] = action_true
+            else:
+                successors = get_successors(line)
+                next_states[state].append(successors)
+
+    return state_def,next_states,rank
+
+def hash_file(file_name):
+    """
+    Returns the sha1 hex digest of a file.
+    """
+    sha = hashlib.sha1()
+    with open(file_name,'rb') as fid:
+        for block in iter(lambda: fid.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _to_csr(lists,index):
+    """
+    Flattens a list of lists of names into offsets and indices into index.
+    """
+    offsets = np.zeros(len(lists)+1,dtype=np.int64)
+    offsets[1:] = np.cumsum([len(l) for l in lists])
+    indices = np.array([index[name] for l in lists for name in l],dtype=np.int64)
+    return offsets,indices
+
+def write_aut_cache(file_cache,file_aut,state_variables,action_variables,state_def,next_states,rank):
+    """
+    Writes a parsed aut file to a binary .npz cache.
+
+    The variables and actions of each state and the successors are stored as
+    offsets into flat index arrays, in the order they appear in the aut file.
+    """
+    states = list(state_def.keys())
+    state_index = dict([(state,ii) for (ii,state) in enumerate(states)])
+    variable_index = dict([(var,ii) for (ii,var) in enumerate(state_variables)])
+    action_index = dict([(act,ii) for (ii,act) in enumerate(action_variables)])
+    variable_offsets,variable_indices = _to_csr([state_def[state] for state in states],variable_index)
+    action_offsets,action_indices = _to_csr([[a for a in next_states[state][:-1] if a != ' '] for state in states],action_index)
+    successor_offsets,successor_indices = _to_csr([next_states[state][-1] for state in states],state_index)
+
+    stat = os.stat(file_aut)
+    file_tmp = file_cache + '.tmp'
+    with open(file_tmp,'wb') as fid:
+        np.savez(fid,
+                 version=np.array(AUT_CACHE_VERSION),
+                 sha1=np.array(hash_file(file_aut)),
+                 mtime=np.array(stat.st_mtime),
+                 size=np.array(stat.st_size),
+                 state_variables=np.array(state_variables,dtype=np.str_),
+                 action_variables=np.array(action_variables,dtype=np.str_),
+                 states=np.array(states,dtype=np.str_),
+                 rank=np.array([rank[state] for state in states],dtype=np.str_),
+                 variable_offsets=variable_offsets,variable_indices=variable_indices,
+                 action_offsets=action_offsets,action_indices=action_indices,
+                 successor_offsets=successor_offsets,successor_indices=successor_indices)
+    os.replace(file_tmp,file_cache)
+
+def load_aut_cache(file_cache,file_aut,state_variables,action_variables):
+    """
+    Loads a parsed aut file written by write_aut_cache.
+
+    Returns None if the cache does not exist or was written for a different
+    aut file or different variables.
+    """
+    if not os.path.exists(file_cache):
+        return None
+    try:
+        data = np.load(file_cache,allow_pickle=False)
+        if int(data['version']) != AUT_CACHE_VERSION:
+            return None
+        if data['state_variables'].tolist() != list(state_variables) or data['action_variables'].tolist() != list(action_variables):
+            return None
+        stat = os.stat(file_aut)
+        if float(data['mtime']) != stat.st_mtime or int(data['size']) != stat.st_size:
+            if str(data['sha1']) != hash_file(file_aut):
+                return None
+    except (OSError,ValueError,KeyError):
+        return None
+
+    states = data['states'].tolist()
+    ranks = data['rank'].tolist()
+    variable_offsets = data['variable_offsets'].tolist()
+    variable_indices = data['variable_indices'].tolist()
+    action_offsets = data['action_offsets'].tolist()
+    action_indices = data['action_indices'].tolist()
+    successor_offsets = data['successor_offsets'].tolist()
+    successor_indices = data['successor_indices'].tolist()
+
+    state_def = {}
+    next_states = {}
+    rank = {}
+    for (ii,state) in enumerate(states):
+        state_def[state] = [state_variables[jj] for jj in variable_indices[variable_offsets[ii]:variable_offsets[ii+1]]]
+        action_true = [action_variables[jj] for jj in action_indices[action_offsets[ii]:action_offsets[ii+1]]]
+        if not action_true:
+            action_true = [' ']
+        action_true.append([states[jj] for jj in successor_indices[successor_offsets[ii]:successor_offsets[ii+1]]])
+        next_states[state] = action_true
+        rank[state] = ranks[ii]
 
     return state_def,next_states,rank
 
+
+class CompiledStrategy(object):
+    """
+    Strategy with the true symbols of each state encoded as an integer bitmask
+    and the transitions indexed by (state, skill, symbol mask), so finding the
+    next state is a single dict lookup.
+    """
+    def __init__(self, state_def, next_states, state_variables):
+        self.symbol_bits = dict([(var, 1 << ii) for (ii, var) in enumerate(state_variables)])
+        self.state_masks = dict([(state, self.symbols_to_mask(variables)) for (state, variables) in state_def.items()])
+        self.skills = dict([(state, next_states[state][0]) for state in next_states])
+
+        # A (state, skill, mask) key matched by more than one successor is stored as -1
+        self.transitions = {}
+        for (state, next_state) in next_states.items():
+            skill = next_state[0]
+            for possible_state in next_state[1]:
+                key = (state, skill, self.state_masks[possible_state])
+                if key in self.transitions and self.transitions[key] != possible_state:
+                    self.transitions[key] = -1
+                else:
+                    self.transitions[key] = possible_state
+
+    def symbols_to_mask(self, symbols_true):
+        """
+        Returns the bitmask of a list of symbols, None if a symbol is not a state variable.
+        """
+        mask = 0
+        for sym in symbols_true:
+            if sym not in self.symbol_bits:
+                return None
+            mask |= self.symbol_bits[sym]
+        return mask
+
+    def find_state_number(self, previous_state_number, previous_skill, symbols_true):
+        """
+        Same as find_state_number, returns -1 if there is no unique valid next state.
+        """
+        skill = self.skills[previous_state_number]
+        assert previous_skill == skill or previous_skill + 'b' == skill, "The previous skill must have been executable"
+        mask = self.symbols_to_mask(symbols_true)
+        if mask is None:
+            return -1
+        return self.transitions.get((previous_state_number, skill, mask), -1)
+
 def parse_spec(file_spec):
     """
     Reads in a spec file and extracts the system and environment variables.
@@ -112,8 +290,7 @@ def get_rank(line):
     """
     Gets the rank of the state.
     """
-    p = re.compile('rank\s(.*?)\s->')
-    m = p.findall(line)
+    m = RANK_PATTERN.findall(line)
     if m[0][0] == '(':
         m = m[0][1:-1]
     else:
@@ -124,29 +301,39 @@ def get_true_variables(line,state_variables):
     """
     Gets the variables that are true.
     """
-    states = '|'.join(state_variables)
-    pre_p = '(' + states + ')' + ':1'
-    p = re.compile(pre_p)
-    m = p.findall(line)
+    key = tuple(state_variables)
+    if key not in TRUE_VARIABLE_PATTERNS:
+        states = '|'.join(state_variables)
+        pre_p = '(' + states + ')' + ':1'
+        TRUE_VARIABLE_PATTERNS[key] = re.compile(pre_p)
+    m = TRUE_VARIABLE_PATTERNS[key].findall(line)
     return m
 
 def get_successors(line):
     """
     Gets the successors to a state.
     """
-    p = re.compile('\s(\d+)')
-    m = p.findall(line)
+    m = SUCCESSOR_PATTERN.findall(line)
     return m
 
 
-def update_state(arg_intermediate_states, arg_state_number, arg_skill_to_run, arg_state_def, arg_next_states):
+def update_state(arg_intermediate_states, arg_state_number, arg_skill_to_run, arg_state_def, arg_next_states, arg_strategy=None, verbose=True):
     """ Returns -1, "" if the sequence of states violates the strategy
+
+    If arg_strategy (a CompiledStrategy) is given it is used to find the next states.
     """
+    if arg_strategy is not None:
+        def find_next_state(state_def, next_states, state, skill, symbols):
+            return arg_strategy.find_state_number(state, skill, symbols)
+    else:
+        find_next_state = find_state_number
     state_number_out = arg_state_number
-    print("updating intermediate state from state: {}".format(state_number_out))
+    if verbose:
+        print("updating intermediate state from state: {}".format(state_number_out))
     for ii in range(len(arg_intermediate_states)-1):
-        print("updating intermediate state: previous state: {}, skill we ran: {}, symbols that became true: {}".format(state_number_out, arg_skill_to_run, arg_intermediate_states[ii+1]))
-        state_number_out_tmp = find_state_number(arg_state_def, arg_next_states, state_number_out, arg_skill_to_run, arg_intermediate_states[ii+1])
+        if verbose:
+            print("updating intermediate state: previous state: {}, skill we ran: {}, symbols that became true: {}".format(state_number_out, arg_skill_to_run, arg_intermediate_states[ii+1]))
+        state_number_out_tmp = find_next_state(arg_state_def, arg_next_states, state_number_out, arg_skill_to_run, arg_intermediate_states[ii+1])
         if state_number_out_tmp == -1:
             return -1, ""
         if arg_next_states[state_number_out_tmp][0] == " " or arg_next_states[state_number_out_tmp][0] == arg_skill_to_run:
@@ -155,13 +342,15 @@ def update_state(arg_intermediate_states, arg_state_number, arg_skill_to_run, ar
         else:
             previous_skill_out = arg_skill_to_run
 
-    print("After updating the state we are at: {}".format(state_number_out))
+    if verbose:
+        print("After updating the state we are at: {}".format(state_number_out))
     # previous_skill_out = arg_next_states[state_number_out][0]
     if arg_next_states[state_number_out][0] == arg_skill_to_run:
-        print("There is! We assume this is due to the limitations of abstraction and the last state is really visited twice.")
-        print("updating intermediate state: previous state: {}, skill we ran: {}, symbols that became true: {}".format(
-            state_number_out, arg_skill_to_run, arg_intermediate_states[-1]))
-        state_number_out_tmp = find_state_number(arg_state_def, arg_next_states, state_number_out, arg_skill_to_run,
+        if verbose:
+            print("There is! We assume this is due to the limitations of abstraction and the last state is really visited twice.")
+            print("updating intermediate state: previous state: {}, skill we ran: {}, symbols that became true: {}".format(
+                state_number_out, arg_skill_to_run, arg_intermediate_states[-1]))
+        state_number_out_tmp = find_next_state(arg_state_def, arg_next_states, state_number_out, arg_skill_to_run,
                                              arg_intermediate_states[-1])
         if state_number_out_tmp == -1:
             return -1, ""
@@ -272,23 +461,119 @@ def find_skill_to_run(next_states, state_number):
 def find_symbols(state, symbols):
     sym_state = []
     for sym_name, sym in symbols.items():
-        tf = sym.in_symbol(state)
         if sym.in_symbol(state):
             sym_state.append(sym_name)
 
     return sym_state
 
+def evaluate_symbols(states, symbols):
+    """ Evaluates every symbol on every row of states.
+
+    Each symbol is called once on the whole (T, D) array. Symbols whose
+    in_symbol does not accept it or does not return a result of shape exactly
+    (T,) are evaluated row by row.
+
+    Returns a (T, S) boolean array and the S symbol names in column order.
+    """
+    states = np.atleast_2d(np.asarray(states))
+    sym_names = list(symbols.keys())
+    in_syms = np.zeros([states.shape[0], len(sym_names)], dtype=bool)
+    for jj, sym_name in enumerate(sym_names):
+        try:
+            tf = np.asarray(symbols[sym_name].in_symbol(states))
+        except (ValueError, IndexError, TypeError):
+            tf = None
+        if tf is not None and tf.shape == (states.shape[0],):
+            in_syms[:, jj] = tf
+        else:
+            in_syms[:, jj] = [bool(symbols[sym_name].in_symbol(state)) for state in states]
+
+    return in_syms, sym_names
+
+def compress_symbols(in_syms, sym_names):
+    """ Run-length compresses a (T, S) symbol matrix into the sequence of
+    symbol lists, keeping a row only when it differs from the one before.
+    """
+    changed = np.any(in_syms[1:] != in_syms[:-1], axis=1)
+    rows = np.concatenate([[0], np.flatnonzero(changed) + 1])
+    return [[sym_names[jj] for jj in np.flatnonzero(in_syms[ii])] for ii in rows]
+
 def find_intermediate_symbols(states, symbols):
-    if type(states) == list:
-        states = np.asarray(states)
-    # print("States: {}".format(states))
-    symbols_out = [find_symbols(states[0, :], symbols)]
-    # print("State: {}, symbols: {}".format(states[0, :2], symbols_out[0]))
-    for state in states:
-        # print("Person: {}".format(p))
-        tmp_syms = find_symbols(state, symbols)
-        if tmp_syms != symbols_out[-1]:
-            tmp_syms2 = find_symbols(state, symbols)
-            symbols_out.append(tmp_syms2)
-
-    return symbols_out
+    """ Returns the sequence of symbols true along a trajectory, with
+    consecutive duplicates removed.
+    """
+    in_syms, sym_names = evaluate_symbols(states, symbols)
+    return compress_symbols(in_syms, sym_names)
+
+def find_intermediate_symbols_batch(trajectories, symbols):
+    """ find_intermediate_symbols for a (N, T, D) array of trajectories,
+    evaluating the symbols on all of them at once.
+    """
+    trajectories = np.asarray(trajectories)
+    n_traj, n_steps = trajectories.shape[:2]
+    in_syms, sym_names = evaluate_symbols(np.reshape(trajectories, [n_traj * n_steps, -1]), symbols)
+    in_syms = np.reshape(in_syms, [n_traj, n_steps, -1])
+    return [compress_symbols(in_syms[ii], sym_names) for ii in range(n_traj)]
+
+def interpolate_segment(start, end, n_rows):
+    """ Returns n_rows evenly spaced rows on the line from start to end, both included.
+    """
+    alpha = np.linspace(0, 1, n_rows)[:, np.newaxis]
+    return (1 - alpha) * start[np.newaxis, :] + alpha * end[np.newaxis, :]
+
+def in_workspace(states, workspace_bnds):
+    """ Returns a (T,) boolean array, True for rows inside the (D, 2) workspace
+    bounds on the first D columns.
+    """
+    workspace_bnds = np.asarray(workspace_bnds)
+    cols = states[:, :workspace_bnds.shape[0]]
+    return np.all((cols >= workspace_bnds[:, 0]) & (cols <= workspace_bnds[:, 1]), axis=1)
+
+def decimate_trajectory(traj, symbols, max_deviation, workspace_bnds=None):
+    """ Removes waypoints from a trajectory without changing the symbols it visits.
+
+    Waypoints are dropped greedily. A run of waypoints is replaced by the
+    straight line between its first and last waypoint only if every dropped
+    waypoint is within max_deviation of that line on every column, the line
+    has the same symbols true as the original trajectory at every dropped
+    waypoint, and, if workspace_bnds is given, the same waypoints inside
+    the workspace. The waypoints on both sides of every change of the symbols
+    and waypoints with -10 entries are always kept, so find_intermediate_symbols
+    of the decimated trajectory is the same as the original.
+
+    Returns the decimated (K, D) trajectory and the (K,) indices of the kept
+    waypoints.
+    """
+    traj = np.atleast_2d(np.asarray(traj, dtype=float))
+    n_rows = traj.shape[0]
+    if n_rows <= 2:
+        return traj.copy(), np.arange(n_rows)
+    in_syms, _ = evaluate_symbols(traj, symbols)
+    in_bnds = in_workspace(traj, workspace_bnds) if workspace_bnds is not None else None
+    # Both waypoints around every change of the symbols are kept
+    unset = np.any(traj == -10, axis=1)
+    fixed = unset.copy()
+    changed = np.any(in_syms[1:] != in_syms[:-1], axis=1)
+    fixed[1:] |= changed
+    fixed[:-1] |= changed
+
+    def segment_ok(ii, jj):
+        line = interpolate_segment(traj[ii], traj[jj], jj - ii + 1)
+        if np.max(np.abs(line - traj[ii:jj + 1])) > max_deviation:
+            return False
+        if in_bnds is not None and np.any(in_workspace(line, workspace_bnds) != in_bnds[ii:jj + 1]):
+            return False
+        line_syms, _ = evaluate_symbols(line, symbols)
+        return np.array_equal(line_syms, in_syms[ii:jj + 1])
+
+    kept = [0]
+    ii = 0
+    while ii < n_rows - 1:
+        jj = ii + 1
+        while jj + 1 < n_rows and not fixed[jj] and not unset[jj + 1] and segment_ok(ii, jj + 1):
+            jj += 1
+        kept.append(jj)
+        ii = jj
+
+    kept = np.array(kept)
+    return traj[kept], kept
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+This file contains a fixed rate control loop for the mobile base.
+
+The loop runs a step function on a rospy.Timer. No step runs after the loop
+returns, so a final stop command is never overridden. The step reads the
+latest cached pose instead of waiting on tf, so a slow transform lookup never
+lowers the control rate. The timing of every cycle is recorded to check the rate
+holds under load.
+"""
+
+import threading
+import time
+
+import numpy as np
+import rospy
+
+
+class ControlLoop(object):
+    """ Runs a step function at a fixed rate until it returns True
+    """
+    def __init__(self, rate=50.0):
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.stats = None
+
+    def run(self, step, timeout=None):
+        """ Calls step() every period until it returns True
+
+        Args:
+            step: function with no arguments, returns True when the control is done
+            timeout: seconds, stop after this long even if step is not done
+
+        Returns:
+            done: True if step finished, False on timeout or shutdown
+        """
+        done = threading.Event()
+        # Held while a step runs, no step starts once stopped is set
+        step_lock = threading.Lock()
+        stopped = threading.Event()
+        jitter = []
+        durations = []
+        errors = []
+
+        def on_timer(event):
+            with step_lock:
+                if done.is_set() or stopped.is_set():
+                    return
+                if event.current_expected is not None and event.current_real is not None:
+                    jitter.append((event.current_real - event.current_expected).to_sec())
+                start = time.time()
+                try:
+                    finished = step()
+                except Exception as e:
+                    errors.append(e)
+                    finished = True
+                durations.append(time.time() - start)
+                if finished:
+                    done.set()
+
+        start_time = time.time()
+        timer = rospy.Timer(rospy.Duration(self.period), on_timer)
+        while not done.wait(0.01):
+            if rospy.is_shutdown() or (timeout is not None and time.time() - start_time > timeout):
+                break
+        # Waits for a step that is still running, so nothing is sent after run returns
+        with step_lock:
+            stopped.set()
+        timer.shutdown()
+        self.stats = loopStats(jitter, durations, self.period, time.time() - start_time)
+
+        if errors:
+            raise errors[0]
+        return done.is_set()
+
+
+def loopStats(jitter, durations, period, elapsed):
+    """ Summarizes the timing of the cycles of a control loop
+
+    A cycle overruns when its step takes longer than the period.
+    """
+    jitter = np.abs(np.array(jitter))
+    durations = np.array(durations)
+    n_cycles = durations.shape[0]
+    return {
+        'cycles': n_cycles,
+        'rate': n_cycles / elapsed if elapsed > 0 else 0.0,
+        'mean_jitter': float(np.mean(jitter)) if jitter.size else 0.0,
+        'max_jitter': float(np.max(jitter)) if jitter.size else 0.0,
+        'max_step_time': float(np.max(durations)) if n_cycles else 0.0,
+        'overruns': int(np.sum(durations > period)),
+    }
@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+
+"""
+This file contains benchmarks of the planning and inverse kinematics hot paths.
+
+Every benchmark is run on synthetic inputs of increasing size and the timings
+are written to a json file, along with the machine they ran on, so the numbers
+from the robot's computer can be compared between versions. With --baseline
+the timings are compared to an earlier run and the script exits with an error
+if any of them got slower than --tolerance.
+
+No ROS installation is needed: if geometry_msgs, tf or the other ROS modules
+the nodes import are missing, stubs are put in their place. The DMP
+benchmarks only run if --dmp_folder, --dmp_opts and --skill are given and
+torch and dl2_lfd are installed.
+
+Run the benchmarks with:
+    python benchmarks.py --output bench.json
+    python benchmarks.py --output bench_new.json --baseline bench.json --tolerance 0.2
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+
+ROS_STUB_MODULES = ['rospy', 'actionlib', 'tf2_ros', 'sensor_msgs.msg', 'control_msgs.msg', 'trajectory_msgs.msg',
+                    'hello_helpers.hello_misc', 'geometry_msgs.msg', 'tf.transformations']
+
+
+class StubModule(types.ModuleType):
+    """ Module whose missing attributes are empty classes, so they can be called, subclassed or imported
+    """
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        stub = type(name, (object,), {'__init__': lambda self, *args, **kwargs: None})
+        setattr(self, name, stub)
+        return stub
+
+
+class StubMessage(object):
+    """ Message with default field values, set from positional or keyword arguments like a ROS message
+    """
+    FIELDS = ()
+
+    def __init__(self, *args, **kwargs):
+        for (name, default) in self.FIELDS:
+            setattr(self, name, default() if callable(default) else default)
+        for ((name, _), value) in zip(self.FIELDS, args):
+            setattr(self, name, value)
+        for (name, value) in kwargs.items():
+            setattr(self, name, value)
+
+
+class Vector3(StubMessage):
+    FIELDS = (('x', 0.0), ('y', 0.0), ('z', 0.0))
+
+
+class Quaternion(StubMessage):
+    FIELDS = (('x', 0.0), ('y', 0.0), ('z', 0.0), ('w', 0.0))
+
+
+class Transform(StubMessage):
+    FIELDS = (('translation', Vector3), ('rotation', Quaternion))
+
+
+def quaternion_from_euler(ai, aj, ak):
+    """ Same as tf.transformations.quaternion_from_euler with the default sxyz axes
+    """
+    ci, si = np.cos(ai / 2), np.sin(ai / 2)
+    cj, sj = np.cos(aj / 2), np.sin(aj / 2)
+    ck, sk = np.cos(ak / 2), np.sin(ak / 2)
+    return np.array([si * cj * ck - ci * sj * sk,
+                     ci * sj * ck + si * cj * sk,
+                     ci * cj * sk - si * sj * ck,
+                     ci * cj * ck + si * sj * sk])
+
+
+def euler_from_quaternion(quaternion):
+    """ Same as tf.transformations.euler_from_quaternion with the default sxyz axes
+    """
+    x, y, z, w = quaternion
+    roll = np.arctan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+    pitch = np.arcsin(np.clip(2 * (w * y - z * x), -1, 1))
+    yaw = np.arctan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+    return roll, pitch, yaw
+
+
+def installRosStubs():
+    """ Puts stubs in sys.modules for the ROS packages that are not installed
+
+    Returns:
+        stubbed: list of the stubbed module names
+    """
+    stubbed = []
+    for module_name in ROS_STUB_MODULES:
+        package_name = module_name.split('.')[0]
+        if package_name in sys.modules and not isinstance(sys.modules[package_name], StubModule):
+            continue
+        if package_name not in sys.modules and importlib.util.find_spec(package_name) is not None:
+            continue
+        parent = None
+        parts = module_name.split('.')
+        for ii in range(len(parts)):
+            name = '.'.join(parts[:ii + 1])
+            if name not in sys.modules:
+                sys.modules[name] = StubModule(name)
+            if parent is not None:
+                setattr(parent, parts[ii], sys.modules[name])
+            parent = sys.modules[name]
+        stubbed.append(module_name)
+
+    if 'geometry_msgs.msg' in stubbed:
+        for msg in [Vector3, Quaternion, Transform]:
+            setattr(sys.modules['geometry_msgs.msg'], msg.__name__, msg)
+    if 'tf.transformations' in stubbed:
+        sys.modules['tf.transformations'].quaternion_from_euler = quaternion_from_euler
+        sys.modules['tf.transformations'].euler_from_quaternion = euler_from_quaternion
+    return stubbed
+
+
+STUBBED_MODULES = installRosStubs()
+
+from aut_tools import parse_aut, find_state_number, find_intermediate_symbols
+from StretchHelpers import findArmExtensionAndRotation, forwardKinematicsStretch, forwardKinematicsStretchBatch, \
+    findArmExtensionAndRotationBatch, findArmOrigin, findHeadingArmExtensionAndRotation
+from StretchSkill import findJointTrajectoryFromCartesianTrajectory, findTrajectoryFromDMP, findTrajectoriesFromDMP
+
+DEFAULT_SIZES = {
+    'ik': [10, 100, 1000],
+    'batch': [100, 1000, 10000, 100000],
+    'trajectory': [10, 100, 1000, 10000],
+    'strategy': [100, 1000, 10000],
+    'symbols': [100, 1000, 10000, 100000],
+    'dmp': [1, 10, 50],
+}
+N_LOOKUPS = 1000
+# The per waypoint heading search is only run up to this many waypoints
+MAX_LOOP_SIZE = 1000
+
+
+class BoxSymbol(object):
+    """ Symbol that is true when the columns dims of a state are within [lower, upper]
+    """
+    def __init__(self, dims, lower, upper):
+        self.dims = list(dims)
+        self.lower = np.array(lower)
+        self.upper = np.array(upper)
+
+    def in_symbol(self, states):
+        values = np.asarray(states)[..., self.dims]
+        return np.all((values >= self.lower) & (values <= self.upper), axis=-1)
+
+
+def timeCall(fn, repeats):
+    """ Runs fn once to warm up and then repeats times
+
+    Returns:
+        timings: dict of the min, mean, median and std of the run times in seconds
+    """
+    fn()
+    times = np.zeros([repeats])
+    for ii in range(repeats):
+        t_start = time.perf_counter()
+        fn()
+        times[ii] = time.perf_counter() - t_start
+    return {
+        'min_s': float(np.min(times)),
+        'mean_s': float(np.mean(times)),
+        'median_s': float(np.median(times)),
+        'std_s': float(np.std(times)),
+    }
+
+
+def randomRobotPoses(n, rng):
+    return np.stack([rng.uniform(-2, 2, n), rng.uniform(-2, 2, n), rng.uniform(0, 2 * np.pi, n)], axis=1)
+
+
+def randomArmJoints(n, rng):
+    return rng.uniform(0.05, 0.45, n), rng.uniform(0.1, np.pi / 2 - 0.1, n)
+
+
+def syntheticCartesianTrajectory(n, rng):
+    """ Base x, y, ee x, y, z trajectory whose end effector goals are reachable facing pi, like the skills' trajectories
+    """
+    traj = np.zeros([n, 5])
+    traj[:, 0] = np.linspace(1, -1, n)
+    traj[:, 1] = 0.5 * np.sin(np.linspace(0, np.pi, n))
+    theta = np.full([n], np.pi)
+    arm_origin_x, arm_origin_y = findArmOrigin(traj[:, 0], traj[:, 1], theta)
+    extension, wrist_theta = randomArmJoints(n, rng)
+    traj[:, 2:4] = forwardKinematicsStretchBatch(np.stack([arm_origin_x, arm_origin_y, theta], axis=1), extension, wrist_theta)
+    traj[:, 4] = rng.uniform(0.6, 1.0, n)
+    return traj
+
+
+def writeSyntheticAut(file_aut, n_states, rng, n_symbols=16, n_skills=8, n_successors=4):
+    """ Writes a strategy in the slugs .aut format with random symbols, skills and successors
+
+    Returns:
+        state_variables, action_variables
+    """
+    state_variables = ["sym_{}".format(ii) for ii in range(n_symbols)]
+    action_variables = ["skill_{}".format(ii) for ii in range(n_skills)]
+    with open(file_aut, 'w') as fid:
+        for state in range(n_states):
+            symbols_true = rng.random(n_symbols) < 0.3
+            skill = rng.integers(n_skills)
+            variables = ["{}:{}".format(var, int(tf)) for (var, tf) in zip(state_variables, symbols_true)]
+            variables += ["{}:{}".format(var, int(ii == skill)) for (ii, var) in enumerate(action_variables)]
+            fid.write("State {} with rank {} -> <{}>\n".format(state, rng.integers(10), ", ".join(variables)))
+            successors = rng.choice(n_states, size=min(n_successors, n_states), replace=False)
+            fid.write("\tWith successors : {}\n".format(", ".join([str(s) for s in successors])))
+    return state_variables, action_variables
+
+
+def syntheticSymbols(rng, n_symbols=12):
+    """ Boxes over the base, end effector and first object columns of the world state
+    """
+    symbols = dict()
+    for ii in range(n_symbols):
+        dims = [[0, 1], [2, 3, 4], [5, 6, 7]][ii % 3]
+        center = rng.uniform(-1.5, 1.5, len(dims))
+        half_width = rng.uniform(0.2, 0.8, len(dims))
+        symbols["sym_{}".format(ii)] = BoxSymbol(dims, center - half_width, center + half_width)
+    return symbols
+
+
+def syntheticWorldStates(n, rng, width=12):
+    t = np.linspace(0, 1, n)[:, np.newaxis]
+    return 2 * np.sin(2 * np.pi * rng.uniform(0.5, 2, [1, width]) * t + rng.uniform(0, 2 * np.pi, [1, width]))
+
+
+def benchIK(sizes, repeats, rng):
+    """ The scalar inverse and forward kinematics, called once per pose, and their batch versions
+    """
+    results = []
+    for n in sizes['ik']:
+        robot_pose = randomRobotPoses(n, rng)
+        extension, wrist_theta = randomArmJoints(n, rng)
+        goals = [forwardKinematicsStretch(robot_pose[ii, 0], robot_pose[ii, 1], robot_pose[ii, 2], extension[ii], wrist_theta[ii]) for ii in range(n)]
+        results.append(('forwardKinematicsStretch', n, timeCall(
+            lambda: [forwardKinematicsStretch(robot_pose[ii, 0], robot_pose[ii, 1], robot_pose[ii, 2], extension[ii], wrist_theta[ii]) for ii in range(n)], repeats)))
+        results.append(('findArmExtensionAndRotation', n, timeCall(
+            lambda: [findArmExtensionAndRotation(goals[ii], robot_pose[ii, 0], robot_pose[ii, 1], robot_pose[ii, 2]) for ii in range(n)], repeats)))
+
+    for n in sizes['batch']:
+        robot_pose = randomRobotPoses(n, rng)
+        extension, wrist_theta = randomArmJoints(n, rng)
+        goals = forwardKinematicsStretchBatch(robot_pose, extension, wrist_theta)
+        results.append(('forwardKinematicsStretchBatch', n, timeCall(lambda: forwardKinematicsStretchBatch(robot_pose, extension, wrist_theta), repeats)))
+        results.append(('findArmExtensionAndRotationBatch', n, timeCall(lambda: findArmExtensionAndRotationBatch(goals, robot_pose), repeats)))
+    return results
+
+
+def benchTrajectories(sizes, repeats, rng):
+    """ The heading search of followTrajectory, once per waypoint, and findJointTrajectoryFromCartesianTrajectory
+    """
+    results = []
+    for n in sizes['trajectory']:
+        traj = syntheticCartesianTrajectory(n, rng)
+        if n <= MAX_LOOP_SIZE:
+            results.append(('followTrajectory heading search', n, timeCall(
+                lambda: [findHeadingArmExtensionAndRotation(d[0], d[1], d[2], d[3], np.pi) for d in traj], repeats)))
+        results.append(('findJointTrajectoryFromCartesianTrajectory', n, timeCall(lambda: findJointTrajectoryFromCartesianTrajectory(traj), repeats)))
+    return results
+
+
+def benchStrategy(sizes, repeats, rng, tmp_dir):
+    """ parse_aut with and without its cache, and find_state_number with and without the compiled strategy
+    """
+    results = []
+    for n in sizes['strategy']:
+        file_aut = os.path.join(tmp_dir, "strategy_{}.aut".format(n))
+        file_cache = file_aut + ".cache.npz"
+        state_variables, action_variables = writeSyntheticAut(file_aut, n, rng)
+        results.append(('parse_aut', n, timeCall(lambda: parse_aut(file_aut, state_variables, action_variables, compile_strategy=True), repeats)))
+        parse_aut(file_aut, state_variables, action_variables, file_cache=file_cache)
+        results.append(('parse_aut cached', n, timeCall(
+            lambda: parse_aut(file_aut, state_variables, action_variables, compile_strategy=True, file_cache=file_cache), repeats)))
+
+        state_def, next_states, _, strategy = parse_aut(file_aut, state_variables, action_variables, compile_strategy=True)
+        states = list(next_states.keys())
+        lookups = []
+        for state in rng.choice(states, N_LOOKUPS):
+            state = str(state)
+            next_state = str(rng.choice(next_states[state][1]))
+            lookups.append((state, next_states[state][0], state_def[next_state]))
+        results.append(('CompiledStrategy.find_state_number', n, timeCall(
+            lambda: [strategy.find_state_number(*lookup) for lookup in lookups], repeats), N_LOOKUPS))
+        # The uncompiled lookup prints every candidate state
+        with contextlib.redirect_stdout(io.StringIO()):
+            timings = timeCall(lambda: [find_state_number(state_def, next_states, *lookup) for lookup in lookups], repeats)
+        results.append(('find_state_number', n, timings, N_LOOKUPS))
+    return results
+
+
+def benchSymbols(sizes, repeats, rng):
+    results = []
+    symbols = syntheticSymbols(rng)
+    for n in sizes['symbols']:
+        states = syntheticWorldStates(n, rng)
+        results.append(('find_intermediate_symbols', n, timeCall(lambda: find_intermediate_symbols(states, symbols), repeats)))
+    return results
+
+
+def benchDMP(sizes, repeats, rng, dmp_folder, dmp_opts, skill_name):
+    """ One rollout per findTrajectoryFromDMP call against a single batched findTrajectoriesFromDMP
+    """
+    results = []
+    start_pose = rng.uniform(-1, 1, dmp_opts['dimension'])
+    for n in sizes['dmp']:
+        end_poses = rng.uniform(-1, 1, [n, dmp_opts['dimension']])
+        results.append(('findTrajectoryFromDMP', n, timeCall(
+            lambda: [findTrajectoryFromDMP(start_pose, end_pose, skill_name, dmp_folder, dmp_opts) for end_pose in end_poses], repeats)))
+        results.append(('findTrajectoriesFromDMP', n, timeCall(
+            lambda: findTrajectoriesFromDMP(start_pose, end_poses, skill_name, dmp_folder, dmp_opts), repeats)))
+    return results
+
+
+def machineInfo():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'commit': commit,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'stubbed_modules': STUBBED_MODULES,
+    }
+
+
+def compareToBaseline(results, baseline, tolerance):
+    """ Returns the results whose min time is more than tolerance slower than the same benchmark and size in baseline
+    """
+    baseline_times = dict([((r['benchmark'], r['size']), r['min_s']) for r in baseline['results']])
+    regressions = []
+    for r in results:
+        key = (r['benchmark'], r['size'])
+        if key in baseline_times and baseline_times[key] > 0:
+            ratio = r['min_s'] / baseline_times[key]
+            if ratio > 1 + tolerance:
+                regressions.append({'benchmark': r['benchmark'], 'size': r['size'], 'baseline_min_s': baseline_times[key],
+                                    'min_s': r['min_s'], 'ratio': ratio})
+    return regressions
+
+
+def runBenchmarks(sizes, repeats, seed=0, dmp_folder=None, dmp_opts=None, skill_name=None):
+    """ Runs every benchmark
+
+    Returns:
+        results: list of dicts with the benchmark name, input size, repeats, timings and time per item in us.
+            The items are the lookups for find_state_number and the input size otherwise.
+    """
+    rng = np.random.default_rng(seed)
+    raw = []
+    raw += benchIK(sizes, repeats, rng)
+    raw += benchTrajectories(sizes, repeats, rng)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw += benchStrategy(sizes, repeats, rng, tmp_dir)
+    raw += benchSymbols(sizes, repeats, rng)
+    if dmp_folder is not None and skill_name is not None:
+        if importlib.util.find_spec('torch') is None or importlib.util.find_spec('dl2_lfd') is None:
+            print("torch or dl2_lfd is not installed, skipping the DMP benchmarks")
+        else:
+            raw += benchDMP(sizes, repeats, rng, dmp_folder, dmp_opts, skill_name)
+
+    results = []
+    for entry in raw:
+        name, size, timings = entry[:3]
+        n_items = entry[3] if len(entry) > 3 else size
+        result = {'benchmark': name, 'size': size, 'n_items': n_items, 'repeats': repeats}
+        result.update(timings)
+        result['per_item_us'] = timings['min_s'] / n_items * 1e6
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", help="json file the results are written to", required=True)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max_size", help="Skip input sizes above this", type=int, default=None)
+    parser.add_argument("--dmp_folder", help="Folder with the DMP weights", default=None)
+    parser.add_argument("--dmp_opts", help="Opts involving plotting, repair, dmps", default=None)
+    parser.add_argument("--skill", help="Skill whose DMP is rolled out", default=None)
+    parser.add_argument("--baseline", help="json file of an earlier run to compare to", default=None)
+    parser.add_argument("--tolerance", help="Allowed relative slow down from the baseline", type=float, default=0.2)
+    args = parser.parse_args()
+
+    sizes = dict([(group, [n for n in group_sizes if args.max_size is None or n <= args.max_size])
+                  for (group, group_sizes) in DEFAULT_SIZES.items()])
+    dmp_opts = None
+    if args.dmp_opts is not None:
+        with open(args.dmp_opts) as f:
+            dmp_opts = json.load(f)
+
+    results = runBenchmarks(sizes, args.repeats, args.seed, args.dmp_folder, dmp_opts, args.skill)
+    for r in results:
+        print("{:45s} {:8d} {:12.6f} s {:10.2f} us/item".format(r['benchmark'], r['size'], r['min_s'], r['per_item_us']))
+
+    output = {'machine': machineInfo(), 'results': results}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            output['regressions'] = compareToBaseline(results, json.load(f), args.tolerance)
+        for r in output['regressions']:
+            print("Regression: {} size {} is {:.2f}x slower than the baseline".format(r['benchmark'], r['size'], r['ratio']))
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    if output.get('regressions'):
+        sys.exit(1)
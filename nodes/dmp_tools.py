@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""
+This file contains tools for running the learned DMP skills.
+
+The DMP networks are kept in an in-process cache so that each skill's weights
+are only read from disk once, instead of on every call to
+findTrajectoryFromDMP.
+
+torch and dl2_lfd are only imported when a network is first loaded or rolled
+out, so importing this module is cheap.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+DEVICE = "cpu"
+HIDDEN_SIZE = 1024
+DEFAULT_CACHE_BYTES = 256 * 1024 ** 2
+
+
+class DMPModelCache(object):
+    """ Least recently used cache of DMP networks
+
+    Networks are loaded once, put in eval mode with gradients disabled, and
+    evicted oldest first once the size of the cached weights exceeds max_bytes.
+    The most recently loaded network is never evicted.
+    """
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, device=DEVICE):
+        self.max_bytes = max_bytes
+        self.device = device
+        self.models = OrderedDict()
+        self.model_bytes = dict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_times = []
+        self.lock = threading.Lock()
+
+    def getModel(self, skill_name, dmp_folder, opts):
+        """ Returns the network for a skill, loading it from disk on a miss
+
+        Args:
+            skill_name: name of the skill, the weights are in dmp_folder + skill_name + ".pt"
+            dmp_folder: folder with the DMP weights
+            opts: dmp options with start_dimension, dimension and basis_fs
+
+        Returns:
+            model: DMPNN
+        """
+        key = (dmp_folder + skill_name, opts['start_dimension'], opts['dimension'], opts['basis_fs'])
+        with self.lock:
+            if key in self.models:
+                self.hits += 1
+                self.models.move_to_end(key)
+                return self.models[key]
+
+            self.misses += 1
+            t_start = time.time()
+            import torch
+            from dl2_lfd.nns.dmp_nn import DMPNN
+            model = DMPNN(opts['start_dimension'], HIDDEN_SIZE, opts['dimension'], opts['basis_fs']).to(self.device)
+            model.load_state_dict(torch.load(dmp_folder + skill_name + ".pt", map_location=self.device))
+            model.eval()
+            for p in model.parameters():
+                p.requires_grad_(False)
+            self.load_times.append(time.time() - t_start)
+
+            n_bytes = sum([t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers())])
+            self.models[key] = model
+            self.model_bytes[key] = n_bytes
+            self.total_bytes += n_bytes
+            self._evict()
+
+            return model
+
+    def setMaxBytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            self.model_bytes.clear()
+            self.total_bytes = 0
+
+    def getStats(self):
+        """ Returns the hit/miss counters and load latencies in seconds
+        """
+        with self.lock:
+            n_requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / n_requests if n_requests > 0 else 0.0,
+                'n_models': len(self.models),
+                'total_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'load_time_mean': float(np.mean(self.load_times)) if self.load_times else 0.0,
+                'load_time_max': float(np.max(self.load_times)) if self.load_times else 0.0,
+            }
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.models) > 1:
+            key, _ = self.models.popitem(last=False)
+            self.total_bytes -= self.model_bytes.pop(key)
+            self.evictions += 1
+
+
+DMP_MODEL_CACHE = DMPModelCache()
+_DMPS = dict()
+
+
+def getDMP(opts):
+    """ Returns the DMP used to roll out the learned weights, one per set of options
+    """
+    key = (opts['basis_fs'], opts['dt'], opts['dimension'])
+    if key not in _DMPS:
+        from dl2_lfd.dmps.dmp import DMP
+        _DMPS[key] = DMP(opts['basis_fs'], opts['dt'], opts['dimension'])
+    return _DMPS[key]
+
+
+def rolloutDMP(starts, skill_name, dmp_folder, opts, model_cache=DMP_MODEL_CACHE):
+    """ Rolls out the DMP of a skill
+
+    Args:
+        starts: np.array [N, 2, D] with the start and end poses of each rollout
+        skill_name: name of the skill
+        dmp_folder: folder with the DMP weights
+        opts: dmp options
+        model_cache: DMPModelCache the network is taken from
+
+    Returns:
+        rollouts: np.array [N, T, D]
+    """
+    import torch
+    from dl2_lfd.helper_funcs.conversions import np_to_pgpu
+
+    model = model_cache.getModel(skill_name, dmp_folder, opts)
+    dmp = getDMP(opts)
+    with torch.no_grad():
+        learned_weights = model(np_to_pgpu(starts))
+        learned_rollouts, _, _ = \
+            dmp.rollout_torch(torch.tensor(starts[:, 0, :]).to(model_cache.device), torch.tensor(starts[:, 1, :]).to(model_cache.device), learned_weights)
+
+    return learned_rollouts.cpu().numpy()
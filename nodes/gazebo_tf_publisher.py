@@ -1,11 +1,13 @@
 #!/usr/bin/env python
+import re
+import time
+from io import BytesIO
+
+import numpy as np
 import rospy
 import tf2_ros
 import gazebo_msgs.msg
 import geometry_msgs.msg
-import time
-
-import pdb
 
 IS_SIM = True
 
@@ -14,42 +16,215 @@ if IS_SIM:
 else:
     ORIGIN_FRAME = 'origin'
 
-if __name__ == '__main__':
-    rospy.init_node('gazebo_tf_broadcaster')
 
-    broadcaster = tf2_ros.StaticTransformBroadcaster()
+def loadFrameRates(param):
+    """ Flattens ~frame_rates into (pattern, rate) pairs, keeping the configured order
+
+    The parameter is a list of {pattern: rate} entries. A single dict is accepted
+    too, but the parameter server does not keep the order of its keys.
+    """
+    if isinstance(param, dict):
+        rospy.logwarn("~frame_rates is a dict, the order its patterns are matched in is not defined")
+        param = [param]
+    frame_rates = []
+    for entry in param:
+        frame_rates.extend(entry.items())
+    return frame_rates
+
+
+class GazeboTfPublisher(object):
+    """ Publishes the gazebo link states as tf frames
+
+    Only links in the ~links allow-list, or matching ~link_regex if no list is
+    given, are published. A frame is only sent again once it moved more than
+    ~position_threshold or rotated more than ~angle_threshold, or after
+    ~keepalive_period seconds so lookups at the current time do not stall.
+    Only links in ~static_links, or matching ~static_link_regex, are sent on the
+    latched static topic, and only until they move. Links of the robot model
+    (~robot_link_regex) are never sent statically, since tf listeners keep a frame
+    first received as static in a cache without history. Every other frame goes
+    through a regular TransformBroadcaster.
+
+    Rates are in ROS time, so they follow the simulation clock with use_sim_time.
+    Each frame is sent at most at the rate of the first ~frame_rates pattern, in
+    the configured order, it matches, or publish_frequency if it matches none.
+    """
+    def __init__(self):
+        self.static_broadcaster = tf2_ros.StaticTransformBroadcaster()
+        self.broadcaster = tf2_ros.TransformBroadcaster()
+
+        self.publish_frequency = rospy.get_param("publish_frequency", 10)
+        self.links = rospy.get_param("~links", [])
+        self.link_regex = re.compile(rospy.get_param("~link_regex", ".*"))
+        self.static_links = rospy.get_param("~static_links", [])
+        # Matches nothing by default
+        self.static_link_regex = re.compile(rospy.get_param("~static_link_regex", "(?!)"))
+        self.robot_link_regex = re.compile(rospy.get_param("~robot_link_regex", "robot::.*"))
+        self.position_threshold = rospy.get_param("~position_threshold", 0.001)
+        self.angle_threshold = rospy.get_param("~angle_threshold", 0.005)
+        self.keepalive_period = rospy.get_param("~keepalive_period", 0.5)
+        self.stats_period = rospy.get_param("~stats_period", 10.0)
+        # List of pattern to max rate in Hz, e.g. [{"robot::base_link": 30}, {".*table.*": 1}], 0 is unlimited
+        self.frame_rates = [(re.compile(pattern), rate) for (pattern, rate) in loadFrameRates(rospy.get_param("~frame_rates", []))]
+        rates = [self.publish_frequency] + [rate for (_, rate) in self.frame_rates]
+        self.min_period = 0.0 if min(rates) <= 0 else 1.0 / max(rates)
+
+        self.names = None
+        self.link_indices = []
+        # One preallocated message per published link, updated in place
+        self.transforms = dict()
+        self.periods = dict()
+        self.sent_poses = dict()
+        self.sent_times = dict()
+        self.configured_static = set()
+        self.static_frames = set()
+        self.dynamic_frames = set()
+        self.last_published = None
+
+        self.stats_start = time.time()
+        self.stats_start_ros = None
+        self.n_callbacks = 0
+        self.n_sent = 0
+        self.n_bytes = 0
+        self.transform_bytes = None
 
-    publish_frequency = rospy.get_param("publish_frequency", 10)
+    def resolveLinks(self, names):
+        """ Finds the indices of the links to publish, only when the link names change
+        """
+        self.names = list(names)
+        if self.links:
+            self.link_indices = [ii for (ii, name) in enumerate(self.names) if name in self.links]
+        else:
+            self.link_indices = [ii for (ii, name) in enumerate(self.names) if self.link_regex.match(name)]
+        for ii in self.link_indices:
+            name = self.names[ii]
+            if name not in self.transforms:
+                transform = geometry_msgs.msg.TransformStamped()
+                transform.header.frame_id = ORIGIN_FRAME
+                transform.child_frame_id = name
+                self.transforms[name] = transform
+                self.periods[name] = self.framePeriod(name)
+                if self.isStaticLink(name):
+                    self.configured_static.add(name)
+        rospy.loginfo("Publishing {} of {} gazebo links".format(len(self.link_indices), len(self.names)))
 
-    last_published = None
+    def isStaticLink(self, name):
+        if self.robot_link_regex.match(name):
+            return False
+        return name in self.static_links or self.static_link_regex.match(name) is not None
 
-    def callback(data):
-        global last_published
-        if last_published and publish_frequency > 0.0 and time.time() - last_published <= 1 / publish_frequency:
+    def framePeriod(self, name):
+        """ Minimum time between two updates of a frame from the rate schedule
+        """
+        rate = self.publish_frequency
+        for (pattern, pattern_rate) in self.frame_rates:
+            if pattern.match(name):
+                rate = pattern_rate
+                break
+        return 1.0 / rate if rate > 0 else 0.0
+
+    def callback(self, data):
+        # The link states have no stamp, ROS time is the simulation time with use_sim_time
+        now = rospy.Time.now()
+        now_sec = now.to_sec()
+        if self.last_published is not None and now_sec < self.last_published:
+            rospy.loginfo("Time moved backwards, resending every frame")
+            self.sent_poses.clear()
+            self.sent_times.clear()
+            self.static_frames.clear()
+            self.dynamic_frames.clear()
+            self.last_published = None
+            self.stats_start_ros = None
+        if self.last_published is not None and now_sec - self.last_published < self.min_period:
             return
-        transforms = []
-        for i in range(len(data.name)):
-            # if data.name[i] == "robot::base_link":
-            #     child_frame = 'base_link'
-            # else:
-            #     continue
-            transform = geometry_msgs.msg.TransformStamped()
-            transform.header.stamp = rospy.Time.now()
-            transform.header.frame_id = ORIGIN_FRAME
-            transform.child_frame_id = data.name[i]
-            # transform.child_frame_id = child_frame
-            transform.transform.translation.x = data.pose[i].position.x
-            transform.transform.translation.y = data.pose[i].position.y
-            transform.transform.translation.z = data.pose[i].position.z
-            transform.transform.rotation.w = data.pose[i].orientation.w
-            transform.transform.rotation.x = data.pose[i].orientation.x
-            transform.transform.rotation.y = data.pose[i].orientation.y
-            transform.transform.rotation.z = data.pose[i].orientation.z
-            transforms.append(transform)
-            # rospy.loginfo("Publishing: {} as {}".format(data.name[i], child_frame))
+        self.last_published = now_sec
+        if self.stats_start_ros is None:
+            self.stats_start_ros = now_sec
+        self.n_callbacks += 1
+        if data.name != self.names:
+            self.resolveLinks(data.name)
+
+        dynamic = []
+        static_changed = False
+        for ii in self.link_indices:
+            name = data.name[ii]
+            pose = data.pose[ii]
+            p = pose.position
+            q = pose.orientation
+            current = np.array([p.x, p.y, p.z, q.x, q.y, q.z, q.w])
+            sent = self.sent_poses.get(name)
+            if sent is not None and now_sec - self.sent_times[name] < self.periods[name]:
+                continue
+            moved = sent is not None and self.hasMoved(sent, current)
+            if sent is not None and not moved and now_sec - self.sent_times[name] < self.keepalive_period:
+                continue
+            if sent is not None and not moved and name in self.static_frames:
+                continue
+
+            transform = self.transforms[name]
+            transform.header.stamp = now
+            transform.transform.translation.x = p.x
+            transform.transform.translation.y = p.y
+            transform.transform.translation.z = p.z
+            transform.transform.rotation.x = q.x
+            transform.transform.rotation.y = q.y
+            transform.transform.rotation.z = q.z
+            transform.transform.rotation.w = q.w
+            self.sent_poses[name] = current
+            self.sent_times[name] = now_sec
+
+            if sent is None and name in self.configured_static:
+                self.static_frames.add(name)
+                static_changed = True
+            else:
+                if name in self.static_frames:
+                    self.static_frames.discard(name)
+                    static_changed = True
+                self.dynamic_frames.add(name)
+                dynamic.append(transform)
+
+        if static_changed:
+            # The static topic is latched with the last message only, so every static frame is sent together
+            self.send(self.static_broadcaster, [self.transforms[name] for name in sorted(self.static_frames)])
+        if dynamic:
+            self.send(self.broadcaster, dynamic)
+        self.logStats(now_sec)
+
+    def hasMoved(self, sent, current):
+        if np.linalg.norm(current[:3] - sent[:3]) > self.position_threshold:
+            return True
+        # Angle between the two rotations from their quaternions
+        dot = min(abs(np.dot(current[3:], sent[3:])), 1.0)
+        return 2 * np.arccos(dot) > self.angle_threshold
+
+    def send(self, broadcaster, transforms):
+        if self.transform_bytes is None and transforms:
+            buff = BytesIO()
+            transforms[0].serialize(buff)
+            self.transform_bytes = len(buff.getvalue())
         broadcaster.sendTransform(transforms)
-        last_published = time.time()
+        self.n_sent += len(transforms)
+        self.n_bytes += len(transforms) * (self.transform_bytes or 0)
+
+    def logStats(self, now_sec):
+        elapsed = time.time() - self.stats_start
+        if elapsed < self.stats_period:
+            return
+        elapsed_ros = now_sec - self.stats_start_ros
+        rospy.loginfo("TF publisher: {:.1f} updates/s, {:.1f} transforms/s, {:.1f} kB/s (wall clock), {:.2f} x real time, {} static and {} dynamic frames".format(
+            self.n_callbacks / elapsed, self.n_sent / elapsed, self.n_bytes / elapsed / 1024,
+            elapsed_ros / elapsed, len(self.static_frames), len(self.dynamic_frames)))
+        self.stats_start = time.time()
+        self.stats_start_ros = now_sec
+        self.n_callbacks = 0
+        self.n_sent = 0
+        self.n_bytes = 0
+
+
+if __name__ == '__main__':
+    rospy.init_node('gazebo_tf_broadcaster')
 
-    rospy.Subscriber("/gazebo/link_states", gazebo_msgs.msg.LinkStates, callback)
+    publisher = GazeboTfPublisher()
+    rospy.Subscriber("/gazebo/link_states", gazebo_msgs.msg.LinkStates, publisher.callback)
 
     rospy.spin()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+This file contains a store of the latest joint states of the robot.
+
+The store is updated from a JointState subscription, so reading the arm
+joints never waits on MoveIt or the driver. Only the joints of interest are
+decoded, with the name to index mapping resolved once per name list, into a
+preallocated buffer. A sequence counter lets readers copy the buffer without
+taking a lock in the callback.
+"""
+
+import time
+from operator import itemgetter
+
+import numpy as np
+import rospy
+
+TELESCOPING_JOINTS = ['joint_arm_l0', 'joint_arm_l1', 'joint_arm_l2', 'joint_arm_l3']
+LIFT_JOINT = 'joint_lift'
+WRIST_YAW_JOINT = 'joint_wrist_yaw'
+ARM_JOINTS = TELESCOPING_JOINTS + [LIFT_JOINT, WRIST_YAW_JOINT]
+
+
+class JointStateStore(object):
+    """ Keeps the position, velocity and effort of the joints of interest from the latest JointState message
+
+    The buffer has one row each for position, velocity and effort and one column
+    per joint in joint_names. The writer makes seq odd while it writes and even
+    once the buffer is consistent again.
+    """
+    def __init__(self, joint_names=ARM_JOINTS):
+        self.joint_names = list(joint_names)
+        self.column = dict([(name, ii) for (ii, name) in enumerate(self.joint_names)])
+        self.buffer = np.full([3, len(self.joint_names)], np.nan)
+        self.stamp = 0.0
+        self.seq = 0
+        self.names = None
+        self.getter = None
+        self.n_resolves = 0
+
+    def resolve(self, names):
+        """ Finds where the joints of interest are in a message's name list
+        """
+        self.names = list(names)
+        self.n_resolves += 1
+        missing = [name for name in self.joint_names if name not in self.names]
+        if missing:
+            rospy.logwarn_throttle(5.0, "Joint states are missing {}".format(missing))
+            self.getter = None
+            return
+        indices = [self.names.index(name) for name in self.joint_names]
+        # itemgetter with one index returns a value instead of a tuple
+        self.getter = itemgetter(*indices) if len(indices) > 1 else (lambda values: (values[indices[0]],))
+
+    def update(self, joint_states):
+        """ Decodes a JointState message into the buffer
+        """
+        if joint_states.name != self.names:
+            self.resolve(joint_states.name)
+        if self.getter is None:
+            return
+        getter = self.getter
+        self.seq += 1
+        self.buffer[0] = getter(joint_states.position)
+        self.buffer[1] = getter(joint_states.velocity) if len(joint_states.velocity) == len(self.names) else np.nan
+        self.buffer[2] = getter(joint_states.effort) if len(joint_states.effort) == len(self.names) else np.nan
+        self.stamp = joint_states.header.stamp.to_sec()
+        self.seq += 1
+
+    def read(self):
+        """ Returns a consistent copy of the buffer, its stamp in seconds and its seq, None, None, 0 if nothing was received
+        """
+        while True:
+            seq = self.seq
+            if seq == 0:
+                return None, None, 0
+            if seq % 2 == 1:
+                time.sleep(0)
+                continue
+            buffer = self.buffer.copy()
+            stamp = self.stamp
+            if self.seq == seq:
+                return buffer, stamp, seq
+
+    def getPositions(self, names):
+        """ Returns the positions of the named joints and the stamp of the message,
+        None, None if no message with all of them was received
+        """
+        buffer, stamp, _ = self.read()
+        if buffer is None:
+            return None, None
+        return buffer[0, [self.column[name] for name in names]], stamp
+
+    def getArmState(self):
+        """ Returns the extension, lift and wrist yaw and the stamp of the message, None, None if none was received
+        """
+        buffer, stamp, _ = self.read()
+        if buffer is None:
+            return None, None
+        positions = buffer[0]
+        return np.array([np.sum(positions[[self.column[name] for name in TELESCOPING_JOINTS]]),
+                         positions[self.column[LIFT_JOINT]], positions[self.column[WRIST_YAW_JOINT]]]), stamp
+
+    def waitForArmState(self, timeout=1.0, poll_rate=100.0):
+        """ Returns getArmState as soon as it is available, None, None on timeout
+        """
+        rate = rospy.Rate(poll_rate)
+        start = time.time()
+        arm_state, stamp = self.getArmState()
+        while arm_state is None and time.time() - start < timeout and not rospy.is_shutdown():
+            rate.sleep()
+            arm_state, stamp = self.getArmState()
+        return arm_state, stamp
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""
+This file contains a kinematic simulator of the stretch with the same skill
+interface as StretchSkill (visitWaypoint, rotateToTheta, moveArm,
+openGripper, closeGripper, followTrajectory, getWorldState).
+
+The base is a unicycle driven by the same feedback linearization and
+velocity threshold as the robot, integrated with a fixed time step. The arm
+moves at a fixed joint speed, and a grasped object moves with the end
+effector. Time is simulated, so skills run much faster than real time and no
+ROS master, Gazebo or MoveIt is needed.
+
+Run a short test trajectory with:
+    python kinematic_sim.py
+"""
+
+import time
+
+import numpy as np
+
+from StretchHelpers import feedbackLin, thresholdVel, findArmOrigin, findHeadingArmExtensionAndRotation, forwardKinematicsStretchBatch, wrapTheta, \
+    FK_TOLERANCE
+from state_schema import WorldStateSchema
+
+# Extension, lift and wrist yaw speeds and limits
+ARM_MAX_VEL = np.array([0.1, 0.1, 0.5])
+ARM_MIN = np.array([0, 0, -np.inf])
+ARM_MAX = np.array([0.5, 1, np.inf])
+# Height of the end effector above the lift position
+EE_HEIGHT_OFFSET = 0.1
+# Objects further than this from the end effector are not grasped
+GRASP_DISTANCE = 0.15
+
+
+class KinematicStretch(object):
+    """ Kinematic stand-in for StretchSkill
+
+    Args:
+        robot_pose: np.array (3,) x, y, theta of the base
+        joints: np.array (3,) extension, lift and wrist yaw
+        objects: dict of object frame to np.array (3,) x, y, z, in the order of the world state
+        dt: simulated time step of the base controllers in seconds
+        max_steps: controllers give up after this many steps
+        base_noise: std of the relative error of the base velocities
+        arm_noise: std of the error of the arm joint goals
+        seed: seed of the noise
+    """
+    def __init__(self, robot_pose=(0, 0, 0), joints=(0, 0.5, 0), objects=None, dt=0.05, max_steps=20000, state_min_width=12,
+                 base_noise=0.0, arm_noise=0.0, seed=None):
+        self.robot_pose = np.array(robot_pose, dtype=float)
+        self.joints = np.array(joints, dtype=float)
+        objects = dict() if objects is None else objects
+        self.state_schema = WorldStateSchema(list(objects.keys()), min_width=state_min_width)
+        self.object_poses = np.array([objects[frame] for frame in self.state_schema.object_frames], dtype=float).reshape([-1, 3])
+        self.dt = dt
+        self.max_steps = max_steps
+        self.reach_map = None
+        self.sim_time = 0.0
+        self.grasped = None
+        self.grasp_offset = None
+        self.base_noise = base_noise
+        self.arm_noise = arm_noise
+        self.rng = np.random.default_rng(seed)
+
+    def getEEPose(self):
+        """ Returns the x, y, z of the end effector
+        """
+        arm_origin_x, arm_origin_y = findArmOrigin(self.robot_pose[0], self.robot_pose[1], self.robot_pose[2])
+        ee_xy = forwardKinematicsStretchBatch(np.array([arm_origin_x, arm_origin_y, self.robot_pose[2]]), self.joints[0], self.joints[2])[0]
+        return np.array([ee_xy[0], ee_xy[1], self.joints[1] + EE_HEIGHT_OFFSET])
+
+    def updateGrasped(self):
+        if self.grasped is not None:
+            self.object_poses[self.grasped] = self.getEEPose() + self.grasp_offset
+
+    def getWorldState(self, out=None):
+        """ Same layout as StretchSkill.getWorldState
+        """
+        row = np.zeros([self.state_schema.width]) if out is None else out
+        ee = self.getEEPose()
+        row[:] = 0
+        row[0:2] = self.robot_pose[:2]
+        row[2:5] = ee
+        for ii, frame in enumerate(self.state_schema.object_frames):
+            row[self.state_schema.objectColumns(frame)] = self.object_poses[ii]
+        if out is None:
+            return row[np.newaxis, :]
+        return out
+
+    def getJointValues(self):
+        return self.joints.copy()
+
+    def getRobotState(self):
+        return np.hstack([self.robot_pose, self.joints])[np.newaxis, :]
+
+    def teleport_base(self, robot_x, robot_y, robot_theta):
+        self.robot_pose = np.array([robot_x, robot_y, wrapTheta(robot_theta)])
+        self.updateGrasped()
+
+    def step(self, cmd_v, cmd_w):
+        """ Integrates the unicycle model for one time step
+        """
+        if self.base_noise > 0:
+            cmd_v *= 1 + self.base_noise * self.rng.standard_normal()
+            cmd_w *= 1 + self.base_noise * self.rng.standard_normal()
+        theta = self.robot_pose[2]
+        self.robot_pose[0] += cmd_v * np.cos(theta) * self.dt
+        self.robot_pose[1] += cmd_v * np.sin(theta) * self.dt
+        self.robot_pose[2] = wrapTheta(theta + cmd_w * self.dt)
+        self.sim_time += self.dt
+        self.updateGrasped()
+
+    def visitWaypoint(self, waypoint_xytheta, arg_close_enough=0.1, arg_epsilon=0.1, arg_maxV=0.1, arg_wheel2center=0.1778, teleport=False):
+        if teleport:
+            self.teleport_base(waypoint_xytheta[0], waypoint_xytheta[1], waypoint_xytheta[2] if waypoint_xytheta[2] != -10 else self.robot_pose[2])
+            return True
+
+        for _ in range(self.max_steps):
+            cmd_vx = waypoint_xytheta[0] - self.robot_pose[0]
+            cmd_vy = waypoint_xytheta[1] - self.robot_pose[1]
+            if np.hypot(cmd_vx, cmd_vy) < arg_close_enough:
+                return True
+            cmd_v, cmd_w = feedbackLin(cmd_vx, cmd_vy, self.robot_pose[2], arg_epsilon)
+            cmd_v, cmd_w = thresholdVel(cmd_v[0], cmd_w[0], arg_maxV, arg_wheel2center)
+            self.step(cmd_v, cmd_w)
+
+        return False
+
+    def rotateToTheta(self, arg_goal_theta, arg_close_enough=0.05):
+        for _ in range(self.max_steps):
+            cmd_w = arg_goal_theta - self.robot_pose[2]
+            if cmd_w >= np.pi:
+                cmd_w -= 2 * np.pi
+            if cmd_w < -np.pi:
+                cmd_w += 2 * np.pi
+            if np.abs(cmd_w) < arg_close_enough:
+                return True
+            self.step(0, cmd_w)
+
+        return False
+
+    def moveArm(self, arg_desired_ext_lift_yaw):
+        """ Moves the arm joints, -10 keeps a joint where it is. Takes the time of the slowest joint.
+        """
+        goal = np.array(arg_desired_ext_lift_yaw, dtype=float)
+        if self.arm_noise > 0:
+            goal = np.where(goal == -10, goal, goal + self.arm_noise * self.rng.standard_normal(3))
+        goal = np.where(goal == -10, self.joints, np.clip(goal, ARM_MIN, ARM_MAX))
+        self.sim_time += np.max(np.abs(goal - self.joints) / ARM_MAX_VEL)
+        self.joints = goal
+        self.updateGrasped()
+
+        return True
+
+    def closeGripper(self, obj_name=None):
+        """ Attaches the object obj_name, or the closest object, if it is within GRASP_DISTANCE of the end effector
+        """
+        if self.object_poses.shape[0] == 0:
+            return False
+        ee = self.getEEPose()
+        dists = np.linalg.norm(self.object_poses - ee, axis=1)
+        if obj_name is not None:
+            candidates = [ii for (ii, frame) in enumerate(self.state_schema.object_frames) if frame.startswith(obj_name)]
+        else:
+            candidates = list(range(self.object_poses.shape[0]))
+        candidates = [ii for ii in candidates if dists[ii] < GRASP_DISTANCE]
+        if not candidates:
+            return False
+        self.grasped = min(candidates, key=lambda ii: dists[ii])
+        self.grasp_offset = self.object_poses[self.grasped] - ee
+
+        return True
+
+    def openGripper(self, obj_name=None):
+        self.grasped = None
+        self.grasp_offset = None
+
+        return True
+
+    def followTrajectory(self, data, teleport=False, cart_traj=False, **kwargs):
+        """ Same as StretchSkill.followTrajectory, without the streamed, concurrent and tracked modes
+        """
+        traj_log = np.zeros([data.shape[0], self.state_schema.width])
+        for ii, d in enumerate(data):
+            if d[0] != -10:
+                if cart_traj:
+                    self.visitWaypoint(np.array([d[0], d[1], -10]), teleport=teleport)
+                else:
+                    self.visitWaypoint(d[:3], teleport=teleport)
+
+            if d[2] != -10 and not teleport and not cart_traj:
+                self.rotateToTheta(d[2])
+
+            if cart_traj:
+                theta = self.robot_pose[2]
+                if self.reach_map is not None:
+                    amount_to_extend, wrist_theta, robot_theta = self.reach_map.query(self.robot_pose[0], self.robot_pose[1], d[2], d[3], theta)
+                else:
+                    # Headings whose IK solution is behind the arm are rejected
+                    amount_to_extend, wrist_theta, robot_theta = findHeadingArmExtensionAndRotation(self.robot_pose[0], self.robot_pose[1], d[2], d[3], theta,
+                                                                                                    fk_tolerance=FK_TOLERANCE)
+                if robot_theta != theta:
+                    self.rotateToTheta(robot_theta)
+                # Unreachable goals leave the arm where it is
+                if not np.isnan(amount_to_extend):
+                    self.moveArm(np.array([amount_to_extend, d[4] - EE_HEIGHT_OFFSET, wrist_theta]))
+            else:
+                self.moveArm(d[3:])
+
+            self.getWorldState(out=traj_log[ii, :])
+
+        return traj_log
+
+
+def testKinematicStretch():
+    """ Drives a short cartesian trajectory, checks the end effector follows it and
+    reports how much faster than real time it ran
+
+    The base stops within 0.05 rad of the heading the arm was solved for, which
+    moves the end effector by up to about 0.03 m at full reach.
+    """
+    sim = KinematicStretch(robot_pose=[0.52, 0.5, np.pi], joints=[0.4, 0.85, 0], objects={'duck_1::body': [0.5, -0.5, 0.8], 'duck_2::body': [-1.5, 0, 0.8]})
+    traj = np.zeros([50, 5])
+    traj[:, 0] = np.linspace(0.52, -1.5, 50)
+    traj[:, 1] = np.linspace(0.5, 0.3, 50)
+    traj[:, 2] = traj[:, 0] - 0.1
+    traj[:, 3] = traj[:, 1] - 0.5
+    traj[:, 4] = 0.9
+
+    t_start = time.time()
+    traj_log = sim.followTrajectory(traj, cart_traj=True)
+    wall_time = time.time() - t_start
+    ee_error = np.linalg.norm(traj_log[:, 2:4] - traj[:, 2:4], axis=1)
+    print("Simulated {:.1f} s in {:.3f} s ({:.0f}x real time), max EE error: {:.3f}".format(
+        sim.sim_time, wall_time, sim.sim_time / wall_time, np.max(ee_error)))
+    assert np.all(ee_error < 0.04), "End effector missed waypoints {}".format(np.flatnonzero(~(ee_error < 0.04)))
+
+
+if __name__ == "__main__":
+    testKinematicStretch()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+This file contains a renderer that saves plots of planned skill trajectories
+in a separate process, so plotting never slows down planning.
+
+The symbols are drawn once when the renderer starts. For every trajectory
+only the trajectory lines are drawn on top of them and removed after saving. The
+worker is spawned rather than forked, since forking the multithreaded rospy
+process can leave it holding locks no thread will release.
+"""
+
+import multiprocessing as mp
+import os
+from queue import Full
+
+import numpy as np
+
+PLOT_LIMITS = np.array([[-2.25, 3], [-2.25, 2.25]])
+
+
+class TrajectoryPlotRenderer(object):
+    """ Saves a plot of each trajectory put on the queue to plot_dir/skill_name.png
+    """
+    def __init__(self, symbols_file, plot_dir, max_queue=10):
+        self.plot_dir = plot_dir
+        ctx = mp.get_context('spawn')
+        self.queue = ctx.Queue(max_queue)
+        self.process = ctx.Process(target=renderLoop, args=(self.queue, symbols_file, plot_dir), daemon=True)
+        self.process.start()
+        self.n_dropped = 0
+
+    def plot(self, skill_name, traj_cartesian):
+        """ Queues a trajectory to plot without waiting, dropping it if the queue is full
+        """
+        try:
+            self.queue.put_nowait((skill_name, np.array(traj_cartesian)))
+        except Full:
+            self.n_dropped += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.process.join(5.0)
+
+
+def renderLoop(queue, symbols_file, plot_dir):
+    """ Plots the trajectories from the queue until None is received
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from synthesis_based_repair.symbols import load_symbols
+    from synthesis_based_repair.visualization import create_ax_array, apply_plot_limits, plot_trajectory
+
+    symbols = load_symbols(symbols_file)
+    fig, ax = create_ax_array(2, ncols=1)
+    apply_plot_limits(ax[0], PLOT_LIMITS)
+    for sym in symbols:
+        symbols[sym].plot(ax[0], dim=2, alpha=0.05)
+    n_lines = len(ax[0].lines)
+    n_collections = len(ax[0].collections)
+
+    item = queue.get()
+    while item is not None:
+        skill_name, traj_cartesian = item
+        trajectories_base = np.zeros([traj_cartesian.shape[0], 3])
+        trajectories_base[:, :2] = traj_cartesian[:, :2]
+        plot_trajectory(traj_cartesian[:, 2:], ax[0], color='red')
+        plot_trajectory(trajectories_base, ax[0], color='blue')
+        fig.savefig(os.path.join(plot_dir, skill_name + ".png"))
+
+        for artist in list(ax[0].lines)[n_lines:] + list(ax[0].collections)[n_collections:]:
+            artist.remove()
+        item = queue.get()
+
+    plt.close(fig)
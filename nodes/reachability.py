@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""
+This file contains a precomputed reachability map for the stretch arm.
+
+The map is a grid over the offset from the base of the robot to the end
+effector goal (dx, dy) and the heading of the base. Each cell stores the arm
+extension and wrist rotation that reach the cell centre, and whether the cell
+is reachable. Choosing a base heading for a waypoint becomes a lookup of the
+reachable headings for its offset followed by a small exact search around the
+chosen heading, falling back to the full heading search when the lookup
+misses. Without the exact search, the extension and wrist rotation stored in
+the cell are returned directly, with an error up to the size of a cell.
+Every solution is checked with the forward kinematics before it is accepted,
+like the cells of the map, so the stored solutions returned without the exact
+search reach the cell centre rather than the goal. Returned headings are
+wrapped to the range of findTheta.
+
+Build a map with:
+    python reachability.py --output reachability_map.npz
+"""
+
+import argparse
+
+import numpy as np
+
+from StretchHelpers import findArmOrigin, findArmExtensionAndRotationBatch, forwardKinematicsStretchBatch, findHeadingArmExtensionAndRotation, findArmExtensionAndRotationArrays, \
+    wrapTheta, armSolutionReaches, FK_TOLERANCE
+
+
+class ReachabilityMap(object):
+    """ Lookup table of (dx, dy, heading) -> (extension, wrist_theta, reachable)
+    """
+    def __init__(self, offsets, headings, extension, wrist_theta, reachable, fk_tolerance=FK_TOLERANCE):
+        self.offsets = offsets
+        self.headings = headings
+        self.extension = extension
+        self.wrist_theta = wrist_theta
+        self.reachable = reachable
+        self.fk_tolerance = fk_tolerance
+        self.offset_min = offsets[0]
+        self.offset_resolution = offsets[1] - offsets[0]
+        self.heading_resolution = headings[1] - headings[0]
+        # Offsets from the chosen heading tried when refining, closest to the cell heading first
+        steps = np.linspace(0, self.heading_resolution / 2, 5)[1:]
+        self.refine_offsets = np.concatenate([[0], np.ravel(np.column_stack([-steps, steps]))])
+
+    @classmethod
+    def build(cls, max_offset=0.8, offset_resolution=0.02, n_headings=180, fk_tolerance=FK_TOLERANCE):
+        """ Builds the map by solving the IK at every cell centre and keeping the
+        cells whose solution the forward kinematics maps back onto the cell centre
+        """
+        n_offsets = int(np.round(2 * max_offset / offset_resolution)) + 1
+        offsets = np.linspace(-max_offset, max_offset, n_offsets)
+        headings = np.linspace(-np.pi/4, 2*np.pi - np.pi/4, n_headings, endpoint=False)
+
+        h, dx, dy = np.meshgrid(headings, offsets, offsets, indexing='ij')
+        h, dx, dy = h.ravel(), dx.ravel(), dy.ravel()
+        arm_origin_x, arm_origin_y = findArmOrigin(0.0, 0.0, h)
+        arm_pose = np.column_stack([arm_origin_x, arm_origin_y, h])
+        goal_xy = np.column_stack([dx, dy])
+        extension, wrist_theta, reachable = findArmExtensionAndRotationBatch(goal_xy, arm_pose)
+        ee_xy = forwardKinematicsStretchBatch(arm_pose, extension, wrist_theta)
+        with np.errstate(invalid='ignore'):
+            reachable &= np.linalg.norm(ee_xy - goal_xy, axis=1) < fk_tolerance
+
+        shape = [n_headings, n_offsets, n_offsets]
+        return cls(offsets, headings,
+                   np.reshape(extension, shape).astype(np.float32),
+                   np.reshape(wrist_theta, shape).astype(np.float32),
+                   np.reshape(reachable, shape), fk_tolerance)
+
+    def save(self, file_name):
+        np.savez_compressed(file_name, offsets=self.offsets, headings=self.headings, extension=self.extension,
+                            wrist_theta=self.wrist_theta, reachable=self.reachable)
+
+    @classmethod
+    def load(cls, file_name):
+        data = np.load(file_name)
+        return cls(data['offsets'], data['headings'], data['extension'], data['wrist_theta'], data['reachable'])
+
+    def lookupHeadings(self, robot_pose_x, robot_pose_y, goal_x, goal_y, robot_theta):
+        """ Finds the headings in the map from which the goal is reachable
+
+        Returns:
+            headings: np.array of reachable headings, closest to robot_theta first
+        """
+        i = int(round((goal_x - robot_pose_x - self.offset_min) / self.offset_resolution))
+        j = int(round((goal_y - robot_pose_y - self.offset_min) / self.offset_resolution))
+        if i < 0 or i >= self.offsets.size or j < 0 or j >= self.offsets.size:
+            return np.empty(0)
+
+        diff = np.mod(self.headings[self.reachable[:, i, j]] - robot_theta + np.pi, 2 * np.pi) - np.pi
+        return wrapTheta(robot_theta + diff[np.argsort(np.abs(diff))])
+
+    def query(self, robot_pose_x, robot_pose_y, goal_x, goal_y, robot_theta, n_refine=3, exact=True):
+        """ Finds the base heading, arm extension and wrist rotation to reach a goal
+
+        Same inputs and outputs as findHeadingArmExtensionAndRotation for a single
+        waypoint. The current heading is kept if the goal is reachable from it.
+        Otherwise the n_refine reachable headings in the map closest to robot_theta
+        are refined with the exact IK, and the full heading search is only run if
+        none of them reach the goal. With exact False the closest reachable cell
+        is returned as stored in the map instead of being refined.
+        """
+        arm_origin_x, arm_origin_y = findArmOrigin(robot_pose_x, robot_pose_y, robot_theta)
+        amount_to_extend, wrist_theta = findArmExtensionAndRotationArrays(goal_x, goal_y, arm_origin_x, arm_origin_y, robot_theta)
+        if armSolutionReaches(goal_x, goal_y, arm_origin_x, arm_origin_y, robot_theta, amount_to_extend, wrist_theta, self.fk_tolerance):
+            return amount_to_extend[()], wrist_theta[()], robot_theta
+        if not exact:
+            amount_to_extend, wrist_theta, heading = self.queryBatch(robot_pose_x, robot_pose_y, goal_x, goal_y, robot_theta, n_refine, exact=False)
+            return amount_to_extend[0], wrist_theta[0], heading[0]
+
+        headings = self.lookupHeadings(robot_pose_x, robot_pose_y, goal_x, goal_y, robot_theta)[:n_refine]
+        if headings.size > 0:
+            headings = np.ravel(headings[:, np.newaxis] + self.refine_offsets[np.newaxis, :])
+            arm_origin_x, arm_origin_y = findArmOrigin(robot_pose_x, robot_pose_y, headings)
+            amount_to_extend, wrist_theta = findArmExtensionAndRotationArrays(goal_x, goal_y, arm_origin_x, arm_origin_y, headings)
+            valid = np.flatnonzero(armSolutionReaches(goal_x, goal_y, arm_origin_x, arm_origin_y, headings, amount_to_extend, wrist_theta, self.fk_tolerance))
+            if valid.size > 0:
+                return amount_to_extend[valid[0]], wrist_theta[valid[0]], wrapTheta(headings[valid[0]])
+
+        amount_to_extend, wrist_theta, heading = findHeadingArmExtensionAndRotation(robot_pose_x, robot_pose_y, goal_x, goal_y, robot_theta,
+                                                                                    fk_tolerance=self.fk_tolerance)
+        return amount_to_extend, wrist_theta, wrapTheta(heading)
+
+    def queryBatch(self, robot_pose_x, robot_pose_y, goal_x, goal_y, robot_theta, n_refine=3, exact=True):
+        """ query for many waypoints at once
+
+        Args:
+            robot_pose_x, robot_pose_y, goal_x, goal_y, robot_theta: scalars or (N,) arrays
+
+        Returns:
+            amount_to_extend, wrist_theta, heading: (N,) arrays
+        """
+        shape = np.broadcast(robot_pose_x, robot_pose_y, goal_x, goal_y, robot_theta).shape
+        x, y, gx, gy, theta = [np.ravel(np.broadcast_to(np.asarray(v, dtype=float), shape))
+                               for v in (robot_pose_x, robot_pose_y, goal_x, goal_y, robot_theta)]
+        arm_origin_x, arm_origin_y = findArmOrigin(x, y, theta)
+        amount_to_extend, wrist_theta = findArmExtensionAndRotationArrays(gx, gy, arm_origin_x, arm_origin_y, theta)
+        amount_to_extend = np.array(amount_to_extend, dtype=float, ndmin=1)
+        wrist_theta = np.array(wrist_theta, dtype=float, ndmin=1)
+        heading = theta.copy()
+        miss = np.flatnonzero(~armSolutionReaches(gx, gy, arm_origin_x, arm_origin_y, theta, amount_to_extend, wrist_theta, self.fk_tolerance))
+        if miss.size == 0:
+            return amount_to_extend, wrist_theta, heading
+
+        # Reachable cells of every missed waypoint, ordered by their heading difference to robot_theta
+        i = np.rint((gx[miss] - x[miss] - self.offset_min) / self.offset_resolution).astype(int)
+        j = np.rint((gy[miss] - y[miss] - self.offset_min) / self.offset_resolution).astype(int)
+        inside = (i >= 0) & (i < self.offsets.size) & (j >= 0) & (j < self.offsets.size)
+        i, j = np.clip(i, 0, self.offsets.size - 1), np.clip(j, 0, self.offsets.size - 1)
+        reachable = self.reachable[:, i, j].T & inside[:, np.newaxis]
+        diff = np.mod(self.headings[np.newaxis, :] - theta[miss, np.newaxis] + np.pi, 2 * np.pi) - np.pi
+        heading_dist = np.where(reachable, np.abs(diff), np.inf)
+        order = np.argsort(heading_dist, axis=1)[:, :n_refine]
+        rows = np.arange(miss.size)
+        found = np.isfinite(heading_dist[rows, order[:, 0]])
+
+        if exact:
+            candidates = theta[miss, np.newaxis] + np.take_along_axis(diff, order, axis=1)
+            candidate_ok = np.isfinite(np.take_along_axis(heading_dist, order, axis=1))
+            candidates = np.reshape(candidates[:, :, np.newaxis] + self.refine_offsets[np.newaxis, np.newaxis, :], [miss.size, -1])
+            candidate_ok = np.repeat(candidate_ok, self.refine_offsets.size, axis=1)
+            origin_x, origin_y = findArmOrigin(x[miss, np.newaxis], y[miss, np.newaxis], candidates)
+            extensions, wrists = findArmExtensionAndRotationArrays(gx[miss, np.newaxis], gy[miss, np.newaxis], origin_x, origin_y, candidates)
+            valid = candidate_ok & armSolutionReaches(gx[miss, np.newaxis], gy[miss, np.newaxis], origin_x, origin_y, candidates,
+                                                      extensions, wrists, self.fk_tolerance)
+            first = np.argmax(valid, axis=1)
+            found = np.any(valid, axis=1)
+            amount_to_extend[miss[found]] = extensions[rows, first][found]
+            wrist_theta[miss[found]] = wrists[rows, first][found]
+            heading[miss[found]] = wrapTheta(candidates[rows, first][found])
+        else:
+            cell = order[:, 0]
+            amount_to_extend[miss[found]] = self.extension[cell, i, j][found]
+            wrist_theta[miss[found]] = self.wrist_theta[cell, i, j][found]
+            heading[miss[found]] = wrapTheta(self.headings[cell][found])
+
+        rest = miss[~found]
+        if rest.size > 0:
+            amount_to_extend[rest], wrist_theta[rest], rest_heading = findHeadingArmExtensionAndRotation(x[rest], y[rest], gx[rest], gy[rest], theta[rest],
+                                                                                                        fk_tolerance=self.fk_tolerance)
+            heading[rest] = wrapTheta(rest_heading)
+        return amount_to_extend, wrist_theta, heading
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", help="File the map is written to", required=True)
+    parser.add_argument("--max_offset", help="Largest base to goal offset in the map (m)", type=float, default=0.8)
+    parser.add_argument("--offset_resolution", help="Size of a cell (m)", type=float, default=0.02)
+    parser.add_argument("--n_headings", help="Number of base headings", type=int, default=180)
+    args = parser.parse_args()
+
+    reach_map = ReachabilityMap.build(args.max_offset, args.offset_resolution, args.n_headings)
+    reach_map.save(args.output)
+    print("Saved reachability map with {} of {} cells reachable to {}".format(
+        np.sum(reach_map.reachable), reach_map.reachable.size, args.output))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+This file contains a planner that plans the next skill in a worker thread
+while the current one executes.
+
+The plan is made for the state the current skill is predicted to end in. It
+is only used if the robot really ends in that strategy state with a world
+state close enough to the prediction, otherwise it is thrown away. A plan that
+is thrown away while it runs is told to stop through its cancel event, so it
+does not compete with the foreground planning.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rospy
+
+
+class SpeculativePlanner(object):
+    """ Runs one speculative plan at a time in a worker thread
+    """
+    def __init__(self, tolerance=0.1):
+        self.tolerance = tolerance
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.cancel_event = None
+        self.predicted_state_number = None
+        self.predicted_world_state = None
+        self.stats = {'hits': 0, 'misses': 0, 'failed': 0}
+
+    def start(self, predicted_state_number, predicted_world_state, plan_fn, *args, **kwargs):
+        """ Starts plan_fn(*args, cancel_event=event, **kwargs) in the worker, replacing any pending plan
+
+        plan_fn should return early once the threading.Event cancel_event is set.
+
+        Args:
+            predicted_state_number: strategy state the plan is made from
+            predicted_world_state: np.array [1, width] world state the plan is made from
+        """
+        self.discard()
+        self.predicted_state_number = predicted_state_number
+        self.predicted_world_state = np.array(predicted_world_state, copy=True)
+        self.cancel_event = threading.Event()
+        self.future = self.executor.submit(plan_fn, *args, cancel_event=self.cancel_event, **kwargs)
+
+    def take(self, state_number, world_state):
+        """ Returns the result of the pending plan if it was made for this state, else None
+
+        Waits for the plan to finish if it is still running. The plan is used if the
+        strategy state is the predicted one and every column of the world state is
+        within self.tolerance of the prediction.
+        """
+        if self.future is None:
+            return None
+        if state_number != self.predicted_state_number or \
+                np.max(np.abs(np.asarray(world_state) - self.predicted_world_state)) > self.tolerance:
+            self.discard()
+            self.stats['misses'] += 1
+            return None
+        future = self.future
+        self.future = None
+        self.cancel_event = None
+        try:
+            result = future.result()
+        except Exception as e:
+            rospy.logwarn("Speculative plan failed: {}".format(e))
+            self.stats['failed'] += 1
+            return None
+        self.stats['hits'] += 1
+        return result
+
+    def discard(self):
+        """ Drops the pending plan, stopping it if it already started
+        """
+        if self.future is not None:
+            self.cancel_event.set()
+            self.future.cancel()
+            self.future = None
+            self.cancel_event = None
+
+    def shutdown(self):
+        self.discard()
+        self.executor.shutdown(wait=False)
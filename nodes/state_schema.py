@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+This file contains the layout of the world state vector and a ring buffer of
+world states. It does not depend on ROS, so it can be used by the kinematic
+simulator and offline tools.
+"""
+
+import numpy as np
+
+
+class WorldStateSchema(object):
+    """ Layout of the world state vector
+
+    The columns are the robot x, y, the end effector x, y, z and the x, y, z of
+    every object, in order. The vector is zero padded to min_width columns so
+    the layout with two objects stays 12 wide.
+    """
+    def __init__(self, object_frames, min_width=12):
+        self.object_frames = list(object_frames)
+        self.columns = ['robot_x', 'robot_y', 'ee_x', 'ee_y', 'ee_z']
+        for frame in self.object_frames:
+            self.columns += [frame + '_x', frame + '_y', frame + '_z']
+        self.width = max(len(self.columns), min_width)
+        self.index = dict([(name, ii) for (ii, name) in enumerate(self.columns)])
+
+    def objectColumns(self, object_frame):
+        """ Returns the slice of the x, y, z columns of an object
+        """
+        start = self.index[object_frame + '_x']
+        return slice(start, start + 3)
+
+    def fill(self, out, robot, ee, objects):
+        """ Writes the world state into out
+
+        Args:
+            out: np.array (width,) written in place
+            robot, ee: Transform of the robot and end effector
+            objects: list of Transform of the objects, in the order of object_frames
+        """
+        out[0] = robot.translation.x
+        out[1] = robot.translation.y
+        out[2] = ee.translation.x
+        out[3] = ee.translation.y
+        out[4] = ee.translation.z
+        col = 5
+        for obj in objects:
+            out[col] = obj.translation.x
+            out[col + 1] = obj.translation.y
+            out[col + 2] = obj.translation.z
+            col += 3
+        out[col:] = 0
+        return out
+
+
+class StateRingBuffer(object):
+    """ Preallocated ring buffer of world state rows
+    """
+    def __init__(self, capacity, width):
+        self.data = np.zeros([capacity, width])
+        self.stamps = np.zeros([capacity])
+        self.capacity = capacity
+        self.count = 0
+
+    def nextRow(self, stamp=0.0):
+        """ Returns a view of the next row to write, overwriting the oldest row once full
+        """
+        idx = self.count % self.capacity
+        self.stamps[idx] = stamp
+        self.count += 1
+        return self.data[idx]
+
+    def latest(self, n=1):
+        """ Returns a copy of the last n rows, oldest first
+        """
+        n = min(n, self.count, self.capacity)
+        idx = np.arange(self.count - n, self.count) % self.capacity
+        return self.data[idx]
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+"""
+This file contains a Monte Carlo evaluator of a strategy with the DMP skills.
+
+Every episode runs the strategy on the kinematic simulator from a randomized
+initial world state, with actuator noise: find the state from the symbols,
+execute the skill and check the symbols that were really visited with
+update_state. Skills that move the base are planned with their DMP until the
+planned trajectory is accepted by the strategy and followed as in
+runStrategyReal. The DownUp skills are executed as in StretchSkill.run_skill,
+with an arm goal solved for the duck and the gripper opened or closed at the
+bottom, since the DMP path of runStrategyReal never moves the gripper.
+Episodes run in a process pool and the success rate, strategy violation rate
+and time to goal are reported.
+
+Evaluate a strategy with:
+    python strategy_eval.py --symbols stretch_symbols.json --skills stretch_skills.json \
+        --spec stretch.structuredslugs --aut stretch_strategy.aut --dmp_folder dmps/ \
+        --dmp_opts dmp_opts.json --goal_states 12 13 --n_episodes 1000 --output eval.json
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import time
+
+import numpy as np
+
+from aut_tools import parse_spec, parse_aut, find_symbols, find_skill_to_run, find_intermediate_symbols, update_state
+from dmp_tools import rolloutDMP
+from kinematic_sim import KinematicStretch, EE_HEIGHT_OFFSET
+from StretchHelpers import findHeadingArmExtensionAndRotation, FK_TOLERANCE
+
+DEFAULT_ROBOT_POSE = [0.75, 0.5, np.pi]
+DEFAULT_JOINTS = [0.45, 0.8, 0]
+DEFAULT_OBJECTS = {'duck_1::body': [0.5, -0.48, 0.77], 'duck_2::body': [-1.5, 0, 0.77]}
+# Height of the end effector above the duck when grasping, as in StretchSkill.run_skill
+GRASP_HEIGHT = 0.07
+OUTCOMES = ['success', 'violation', 'invalid_start', 'plan_failure', 'grasp_failure', 'stuck', 'timeout']
+
+# Loaded once per worker process by initWorker
+EVAL_CONTEXT = dict()
+
+
+def initWorker(config):
+    """ Loads the symbols, skills and strategy in a worker process
+    """
+    import torch
+    from synthesis_based_repair.skills import load_skills_from_json
+    from synthesis_based_repair.symbols import load_symbols
+
+    # One thread per worker, the pool already uses every core
+    torch.set_num_threads(1)
+    state_variables, action_variables = parse_spec(config['spec'])
+    state_def, next_states, rank_def, strategy = parse_aut(config['aut'], state_variables, action_variables, compile_strategy=True, file_cache=config['aut'] + ".cache.npz")
+    EVAL_CONTEXT.update({
+        'config': config,
+        'symbols': load_symbols(config['symbols']),
+        'skills': load_skills_from_json(config['skills']),
+        'state_def': state_def,
+        'next_states': next_states,
+        'strategy': strategy,
+    })
+
+
+def randomSimulator(config, seed):
+    """ Simulator with the robot and objects perturbed around their nominal poses
+    """
+    rng = np.random.default_rng(seed)
+    robot_pose = np.array(config['robot_pose']) + rng.normal(0, 1, 3) * np.array([config['robot_noise'], config['robot_noise'], config['heading_noise']])
+    objects = dict()
+    for (frame, pose) in config['objects'].items():
+        objects[frame] = np.array(pose) + np.append(rng.normal(0, config['object_noise'], 2), 0)
+    return KinematicStretch(robot_pose=robot_pose, joints=config['joints'], objects=objects,
+                            base_noise=config['base_noise'], arm_noise=config['arm_noise'], seed=seed)
+
+
+def planSkill(skill_name, world_state, state_number, ctx):
+    """ Rolls out the DMP of a skill until the strategy accepts the planned trajectory, None if it never does
+    """
+    config = ctx['config']
+    robot_state = world_state[0, :5]
+    for _ in range(config['max_attempts']):
+        end_robot = np.reshape(ctx['skills'][skill_name].get_final_robot_pose(robot_state, world_state, ctx['symbols']), [-1])
+        starts = np.zeros([1, 2, robot_state.size])
+        starts[0, 0, :] = robot_state
+        starts[0, 1, :] = end_robot
+        traj = np.vstack([rolloutDMP(starts, skill_name, config['dmp_folder'], config['dmp_opts'])[0], end_robot])
+        planned_symbols = find_intermediate_symbols(traj, ctx['symbols'])
+        next_state_number, _ = update_state(planned_symbols, state_number, skill_name, ctx['state_def'], ctx['next_states'], arg_strategy=ctx['strategy'], verbose=False)
+        if next_state_number != -1:
+            return traj
+    return None
+
+
+def executeDownUp(sim, skill_name, ctx):
+    """ The DownUp skills of StretchSkill.run_skill: reach down to the duck, grasp or release it and lift
+
+    The arm goal is solved with the simulator's kinematics from the current base
+    pose, instead of the fixed arm offset of the robot, so the end effector ends
+    GRASP_HEIGHT above the duck. A duck the arm cannot reach without turning the
+    base leaves the arm where it is.
+
+    Returns:
+        states: np.array [3, width] world states before, at the bottom and after lifting
+        grasped: False if a pickup did not grasp the duck
+    """
+    syms = ctx['skills'][skill_name].get_ee_final_symbol()
+    duck = 'duck_1' if "duck_a_" + skill_name[-1] in syms else 'duck_2'
+    duck_pose = sim.object_poses[sim.state_schema.object_frames.index(duck + "::body")]
+    ext, yaw, _ = findHeadingArmExtensionAndRotation(sim.robot_pose[0], sim.robot_pose[1], duck_pose[0], duck_pose[1], sim.robot_pose[2],
+                                                     theta_offsets=np.zeros([1]), fk_tolerance=FK_TOLERANCE)
+    if np.isnan(ext):
+        ext, yaw = -10, -10
+    lift = duck_pose[2] + GRASP_HEIGHT - EE_HEIGHT_OFFSET
+    states = np.zeros([3, sim.state_schema.width])
+    sim.getWorldState(out=states[0, :])
+    sim.moveArm(np.array([ext, lift, yaw]))
+    sim.getWorldState(out=states[1, :])
+    grasped = True
+    if 'place' in skill_name:
+        sim.openGripper(duck)
+    elif 'pickup' in skill_name:
+        grasped = sim.closeGripper(duck)
+    sim.moveArm(np.array([-10, lift + 0.2, -10]))
+    sim.getWorldState(out=states[2, :])
+    return states, grasped
+
+
+def runEpisode(task):
+    """ Runs the strategy from a random initial state until a goal state, a failure or max_skills skills
+
+    The outcome is one of OUTCOMES: 'violation' if update_state rejects the
+    symbols the robot visited, 'invalid_start' if the initial world state does
+    not match initial_state, 'stuck' if the strategy has nothing left to do
+    before a goal state, and 'timeout' after max_skills skills.
+
+    Returns:
+        result: dict with the outcome, the number of skills run, the simulated time and the time to goal
+    """
+    episode, seed = task
+    ctx = EVAL_CONTEXT
+    config = ctx['config']
+    np.random.seed(seed)
+    sim = randomSimulator(config, seed)
+    goal_states = set([str(state) for state in config['goal_states']])
+
+    previous_state_number = config['initial_state']
+    previous_skill = ' '
+    outcome = 'timeout'
+    n_skills = 0
+    while n_skills < config['max_skills']:
+        world_state = sim.getWorldState()
+        state_number = ctx['strategy'].find_state_number(previous_state_number, previous_skill, find_symbols(world_state, ctx['symbols']))
+        if state_number == -1:
+            outcome = 'invalid_start' if n_skills == 0 else 'violation'
+            break
+        if str(state_number) in goal_states:
+            outcome = 'success'
+            break
+        skill_name = find_skill_to_run(ctx['next_states'], state_number)
+        if skill_name == " ":
+            outcome = 'stuck'
+            break
+
+        if 'DownUp' in skill_name:
+            states, grasped = executeDownUp(sim, skill_name, ctx)
+            if not grasped:
+                n_skills += 1
+                outcome = 'grasp_failure'
+                break
+        else:
+            traj = planSkill(skill_name, world_state, state_number, ctx)
+            if traj is None:
+                outcome = 'plan_failure'
+                break
+            states = sim.followTrajectory(traj, cart_traj=True)
+        n_skills += 1
+
+        visited = find_intermediate_symbols(np.vstack([world_state, states]), ctx['symbols'])
+        previous_state_number, previous_skill = update_state(visited, state_number, skill_name, ctx['state_def'], ctx['next_states'], arg_strategy=ctx['strategy'], verbose=False)
+        if previous_state_number == -1:
+            outcome = 'violation'
+            break
+
+    return {
+        'episode': episode,
+        'seed': seed,
+        'outcome': outcome,
+        'n_skills': n_skills,
+        'sim_time': sim.sim_time,
+        'time_to_goal': sim.sim_time if outcome == 'success' else None,
+    }
+
+
+def summarize(results, wall_time):
+    """ Rates of each outcome and the distribution of the time to goal
+    """
+    n_episodes = len(results)
+    outcomes = [result['outcome'] for result in results]
+    n_valid = n_episodes - outcomes.count('invalid_start')
+    times = np.array([result['time_to_goal'] for result in results if result['time_to_goal'] is not None])
+    summary = {
+        'n_episodes': n_episodes,
+        'wall_time': wall_time,
+        'episodes_per_s': n_episodes / wall_time if wall_time > 0 else 0.0,
+        'mean_skills': float(np.mean([result['n_skills'] for result in results])) if results else 0.0,
+    }
+    for outcome in OUTCOMES:
+        summary[outcome + '_rate'] = outcomes.count(outcome) / n_episodes if n_episodes > 0 else 0.0
+    # Rates over the episodes whose initial state matched the strategy
+    summary['n_valid_starts'] = n_valid
+    summary['valid_success_rate'] = outcomes.count('success') / n_valid if n_valid > 0 else 0.0
+    summary['valid_violation_rate'] = outcomes.count('violation') / n_valid if n_valid > 0 else 0.0
+    if times.size > 0:
+        summary['time_to_goal'] = {
+            'mean': float(np.mean(times)),
+            'std': float(np.std(times)),
+            'p10': float(np.percentile(times, 10)),
+            'p50': float(np.percentile(times, 50)),
+            'p90': float(np.percentile(times, 90)),
+            'max': float(np.max(times)),
+        }
+    return summary
+
+
+def evaluateStrategy(config, n_episodes, n_workers=None, seed=0):
+    """ Runs n_episodes episodes across a pool of n_workers processes (one per core if None)
+
+    config['goal_states'] must list the strategy states that count as reaching the goal.
+
+    Returns:
+        summary: dict from summarize
+        results: list of the result of every episode, in episode order
+    """
+    if not config['goal_states']:
+        raise ValueError("At least one goal state is needed to tell successful episodes apart")
+    tasks = [(ii, seed + ii) for ii in range(n_episodes)]
+    t_start = time.time()
+    with mp.Pool(n_workers, initializer=initWorker, initargs=(config,)) as pool:
+        results = list(pool.imap_unordered(runEpisode, tasks, chunksize=max(1, n_episodes // (8 * (n_workers or mp.cpu_count())))))
+    results.sort(key=lambda result: result['episode'])
+    return summarize(results, time.time() - t_start), results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--symbols", help="Symbols json file", required=True)
+    parser.add_argument("--skills", help="Skills json file", required=True)
+    parser.add_argument("--spec", help="Structured slugs specification", required=True)
+    parser.add_argument("--aut", help="Strategy .aut file", required=True)
+    parser.add_argument("--dmp_folder", help="Folder with the DMP weights", required=True)
+    parser.add_argument("--dmp_opts", help="Opts involving plotting, repair, dmps", required=True)
+    parser.add_argument("--output", help="File the summary and episode results are written to", required=True)
+    parser.add_argument("--n_episodes", type=int, default=1000)
+    parser.add_argument("--n_workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max_skills", help="Episodes stop after this many skills", type=int, default=10)
+    parser.add_argument("--max_attempts", help="DMP rollouts tried per skill before giving up", type=int, default=20)
+    parser.add_argument("--initial_state", default='0')
+    parser.add_argument("--goal_states", help="Strategy states that end an episode successfully", nargs='+', required=True)
+    parser.add_argument("--robot_noise", help="Std of the initial robot position (m)", type=float, default=0.05)
+    parser.add_argument("--heading_noise", help="Std of the initial robot heading (rad)", type=float, default=0.05)
+    parser.add_argument("--object_noise", help="Std of the initial object positions (m)", type=float, default=0.02)
+    parser.add_argument("--base_noise", help="Std of the relative error of the base velocities", type=float, default=0.05)
+    parser.add_argument("--arm_noise", help="Std of the error of the arm joint goals", type=float, default=0.005)
+    args = parser.parse_args()
+
+    with open(args.dmp_opts) as f:
+        dmp_opts = json.load(f)
+    config = {
+        'symbols': args.symbols,
+        'skills': args.skills,
+        'spec': args.spec,
+        'aut': args.aut,
+        'dmp_folder': args.dmp_folder,
+        'dmp_opts': dmp_opts,
+        'robot_pose': DEFAULT_ROBOT_POSE,
+        'joints': DEFAULT_JOINTS,
+        'objects': DEFAULT_OBJECTS,
+        'max_skills': args.max_skills,
+        'max_attempts': args.max_attempts,
+        'initial_state': args.initial_state,
+        'goal_states': args.goal_states,
+        'robot_noise': args.robot_noise,
+        'heading_noise': args.heading_noise,
+        'object_noise': args.object_noise,
+        'base_noise': args.base_noise,
+        'arm_noise': args.arm_noise,
+    }
+
+    summary, results = evaluateStrategy(config, args.n_episodes, args.n_workers, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump({'config': config, 'summary': summary, 'results': results}, f, indent=2)
+    print(json.dumps(summary, indent=2))
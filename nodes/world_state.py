@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+This file contains a tracker that keeps the latest pose of every frame the
+skills need (robot, end effector, objects). The layout of the world state
+vector built from those poses is in state_schema.
+
+A timer looks up the latest available transform of each frame in the
+background, so reading the world state never waits on tf. It also looks up
+every frame at the latest time they all have transforms for, so a snapshot of
+the world state is consistent in time.
+"""
+
+import threading
+from collections import namedtuple
+
+import rospy
+import tf2_ros
+
+WorldSnapshot = namedtuple('WorldSnapshot', ['stamp', 'transforms', 'ages'])
+
+
+class WorldStateTracker(object):
+    """ Keeps the latest transform from the origin frame to each tracked frame
+    """
+    def __init__(self, tf_buffer, origin_frame=None, frames=None, update_rate=50.0):
+        self.tf_buffer = tf_buffer
+        self.origin_frame = origin_frame
+        self.frames = list(frames) if frames is not None else []
+        self.transforms = dict()
+        self.stamps = dict()
+        # Every frame at one common stamp, None until all frames have been seen
+        self.snapshot_transforms = None
+        self.snapshot_stamps = None
+        self.lock = threading.Lock()
+        self.timer = rospy.Timer(rospy.Duration(1.0 / update_rate), self.update)
+
+    def setOriginFrame(self, origin_frame):
+        with self.lock:
+            self.origin_frame = origin_frame
+            self.transforms.clear()
+            self.stamps.clear()
+            self.snapshot_transforms = None
+            self.snapshot_stamps = None
+
+    def addFrame(self, frame):
+        with self.lock:
+            if frame not in self.frames:
+                self.frames.append(frame)
+                self.snapshot_transforms = None
+                self.snapshot_stamps = None
+
+    def setFrames(self, frames):
+        with self.lock:
+            self.frames = list(frames)
+            self.snapshot_transforms = None
+            self.snapshot_stamps = None
+
+    def update(self, event=None):
+        """ Looks up the latest transform of every frame, skipping frames tf does not have yet
+
+        Once every frame is available, they are also looked up at the oldest of
+        their latest stamps for the snapshot. Frames made only of static
+        transforms have a zero stamp and are the same at any time.
+        """
+        if self.origin_frame is None:
+            return
+        with self.lock:
+            origin_frame = self.origin_frame
+            frames = list(self.frames)
+        latest = dict()
+        for frame in frames:
+            try:
+                trans_stamped = self.tf_buffer.lookup_transform(origin_frame, frame, rospy.Time(0))
+            except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
+                continue
+            latest[frame] = trans_stamped
+            with self.lock:
+                if origin_frame != self.origin_frame:
+                    return
+                self.transforms[frame] = trans_stamped.transform
+                self.stamps[frame] = trans_stamped.header.stamp
+
+        if len(latest) < len(frames):
+            return
+        stamps = [t.header.stamp for t in latest.values() if not t.header.stamp.is_zero()]
+        snapshot_transforms = dict()
+        snapshot_stamps = dict()
+        common_stamp = min(stamps) if stamps else None
+        for (frame, trans_stamped) in latest.items():
+            if common_stamp is not None and not trans_stamped.header.stamp.is_zero() and trans_stamped.header.stamp != common_stamp:
+                try:
+                    trans_stamped = self.tf_buffer.lookup_transform(origin_frame, frame, common_stamp)
+                except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
+                    return
+            snapshot_transforms[frame] = trans_stamped.transform
+            snapshot_stamps[frame] = trans_stamped.header.stamp
+        with self.lock:
+            if origin_frame != self.origin_frame or frames != self.frames:
+                return
+            self.snapshot_transforms = snapshot_transforms
+            self.snapshot_stamps = snapshot_stamps
+
+    def getPose(self, frame):
+        """ Returns the latest transform of a frame and its stamp, None, None if it has not been seen
+        """
+        with self.lock:
+            return self.transforms.get(frame), self.stamps.get(frame)
+
+    def getSnapshot(self, max_staleness=None):
+        """ Returns the transforms of all frames at their latest common stamp without waiting
+
+        Args:
+            max_staleness: seconds, if given frames older than this count as missing
+
+        Returns:
+            WorldSnapshot with the common stamp, a dict of transforms and a dict
+            of ages in seconds, or None if a frame is missing
+        """
+        now = rospy.Time.now()
+        with self.lock:
+            if self.snapshot_transforms is None:
+                return None
+            transforms = dict(self.snapshot_transforms)
+            stamps = dict(self.snapshot_stamps)
+
+        ages = dict([(frame, frameAge(now, stamp)) for (frame, stamp) in stamps.items()])
+        if max_staleness is not None and any([age > max_staleness for age in ages.values()]):
+            return None
+
+        # Static frames have a zero stamp, every other frame has the common stamp
+        return WorldSnapshot(max(stamps.values()), transforms, ages)
+
+    def waitForSnapshot(self, max_staleness=None, poll_rate=100.0):
+        """ Returns getSnapshot as soon as every frame is available and fresh enough, None on shutdown
+        """
+        rate = rospy.Rate(poll_rate)
+        cnt = 1
+        snapshot = self.getSnapshot(max_staleness)
+        while snapshot is None and not rospy.is_shutdown():
+            rate.sleep()
+            cnt += 1
+            if cnt % int(poll_rate) == 0:
+                rospy.loginfo("Waiting for transforms of {} from {}".format(self.missingFrames(max_staleness), self.origin_frame))
+            snapshot = self.getSnapshot(max_staleness)
+
+        return snapshot
+
+    def missingFrames(self, max_staleness=None):
+        now = rospy.Time.now()
+        with self.lock:
+            return [frame for frame in self.frames if frame not in self.stamps or
+                    (max_staleness is not None and frameAge(now, self.stamps[frame]) > max_staleness)]
+
+
+def frameAge(now, stamp):
+    """ Age of a transform in seconds. Transforms made only of static transforms
+    have a zero stamp and never go stale.
+    """
+    if stamp.is_zero():
+        return 0.0
+    return (now - stamp).to_sec()